@@ -0,0 +1,389 @@
+import csv
+import io
+import os
+import random
+import sys
+import tarfile
+from multiprocessing import Pool
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torchvision import transforms as trn
+from runtime import image_way_id
+
+"""
+Datasets for the street image classifier. Splits are read from the CSV
+manifests written by scripts/splits.py (filename, path, label, region), so
+images stay where they were downloaded instead of being copied into
+train/val/test folders.
+
+    data = {split: ManifestDataset(split_path(split), transform=image_transforms[split])
+            for split in ['train', 'val', 'test']}
+
+For faster epochs, a split can be packed into tar shards (the WebDataset
+layout: <key>.jpg and <key>.cls members), read either sequentially with
+ShardIterableDataset or randomly through an offset index with ShardDataset.
+
+    python bike_data.py pack train [shard_size]
+
+Val and test use only deterministic transforms, so they can instead be
+cached once as 224x224 uint8 crops in a memory-mapped array, and normalized
+a whole batch at a time (TensorCacheDataset, normalize_batch).
+
+    python bike_data.py cache val
+"""
+
+SPLIT_DIR = '../data/splits/'
+
+SHARD_DIR = '../data/shards/'
+
+CACHE_DIR = '../data/tensor_cache/'
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# The deterministic part of the notebook's val/test transform
+RESIZE_CROP = trn.Compose([trn.Resize(size=256), trn.CenterCrop(size=224)])
+
+# The notebook's image transforms
+TRAIN_TRANSFORM = trn.Compose([
+    trn.Resize(size=256),
+    trn.RandomRotation(degrees=15),
+    trn.ColorJitter(),
+    trn.RandomHorizontalFlip(),
+    trn.CenterCrop(size=224),
+    trn.ToTensor(),
+    trn.Normalize(MEAN, STD)
+])
+
+EVAL_TRANSFORM = trn.Compose([
+    trn.Resize(size=256),
+    trn.CenterCrop(size=224),
+    trn.ToTensor(),
+    trn.Normalize(MEAN, STD)
+])
+
+
+def split_path(split, split_dir=SPLIT_DIR):
+    return os.path.join(split_dir, split + '.csv')
+
+
+def shard_dir(split, root=SHARD_DIR):
+    return os.path.join(root, split)
+
+
+def cache_dir(split, root=CACHE_DIR):
+    return os.path.join(root, split)
+
+
+def read_manifest(filename):
+    """ Rows of a split manifest, as dicts """
+    with open(filename, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+class ImageListDataset(Dataset):
+    """
+    Images from a list of (path, label) samples. Like ImageFolderWithPaths,
+    items are (image, label, path), and classes/class_to_idx match an
+    ImageFolder over 0/ and 1/ folders. Unlabeled images have label -1.
+    """
+
+    classes = ['0', '1']
+    class_to_idx = {'0': 0, '1': 1}
+
+    def __init__(self, samples, transform=None):
+        self.samples = samples
+        self.targets = [label for _, label in samples]
+        self.transform = transform
+
+    @classmethod
+    def from_directory(cls, dirname, transform=None):
+        """ Every .jpg directly in dirname, unlabeled """
+        paths = sorted(entry.path for entry in os.scandir(dirname)
+                       if entry.is_file() and entry.name.endswith('.jpg'))
+        return cls([(path, -1) for path in paths], transform)
+
+    @property
+    def imgs(self):
+        return self.samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        path, label = self.samples[index]
+        with open(path, 'rb') as f:
+            img = Image.open(f).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, label, path
+
+
+class ManifestDataset(ImageListDataset):
+    """ Images listed in a split manifest """
+
+    def __init__(self, manifest, transform=None):
+        rows = read_manifest(manifest)
+        super(ManifestDataset, self).__init__(
+            [(row['path'], int(row['label'])) for row in rows], transform)
+        self.regions = [row['region'] for row in rows]
+
+
+def decode(data):
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(manifest, out_dir, shard_size=1000):
+    """
+    Pack the images of a split manifest into tar shards of shard_size
+    images each, in manifest order, and write an index.csv giving the
+    shard, byte offset and size of every image so shards can also be read
+    at random.
+    """
+    rows = read_manifest(manifest)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(os.path.join(out_dir, 'index.csv'), 'w', newline='') as f:
+        index = csv.writer(f)
+        index.writerow(['shard', 'offset', 'size', 'label', 'path'])
+
+        for start in range(0, len(rows), shard_size):
+            shard = 'shard-{:05d}.tar'.format(start // shard_size)
+            shard_rows = rows[start:start + shard_size]
+            with tarfile.open(os.path.join(out_dir, shard), 'w') as tar:
+                for row in shard_rows:
+                    key = os.path.splitext(row['filename'])[0]
+                    with open(row['path'], 'rb') as image:
+                        _add_member(tar, key + '.jpg', image.read())
+                    _add_member(tar, key + '.cls', row['label'].encode('ascii'))
+
+            # Read the data offsets back from the headers rather than assume a layout
+            with tarfile.open(os.path.join(out_dir, shard), 'r') as tar:
+                images = [m for m in tar.getmembers() if m.name.endswith('.jpg')]
+            for member, row in zip(images, shard_rows):
+                index.writerow([shard, member.offset_data, member.size, row['label'], row['path']])
+            print(shard, "written")
+
+
+def shard_filenames(dirname):
+    return sorted(os.path.join(dirname, f) for f in os.listdir(dirname) if f.endswith('.tar'))
+
+
+class ShardIterableDataset(IterableDataset):
+    """
+    Stream (image, label, path) from tar shards with large sequential reads.
+    Shards are divided between DataLoader workers; with shuffle, samples are
+    mixed through a shuffle buffer, and shard order changes with the epoch.
+    DataLoader workers get copies of the dataset, so call set_epoch(epoch)
+    on it before each epoch of training.
+    """
+
+    def __init__(self, dirname, transform=None, shuffle=False, buffer_size=1000):
+        self.shards = shard_filenames(dirname)
+        with open(os.path.join(dirname, 'index.csv'), newline='') as f:
+            self.length = sum(1 for _ in f) - 1
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.epoch = 0
+
+    def __len__(self):
+        return self.length
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _samples(self, shards):
+        for shard in shards:
+            # Stream mode: one forward pass over the file, no seeking
+            with tarfile.open(shard, 'r|') as tar:
+                image = None
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name.endswith('.jpg'):
+                        image = (member.name[:-4], data)
+                    elif member.name.endswith('.cls') and image is not None:
+                        yield image[1], int(data), os.path.join(shard, image[0] + '.jpg')
+                        image = None
+
+    def __iter__(self):
+        shards = list(self.shards)
+        # Every worker draws the same shard order, so each shard is read once
+        rng = random.Random(self.epoch)
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+
+        samples = self._samples(shards)
+        if self.shuffle:
+            samples = _shuffled(samples, self.buffer_size, rng)
+
+        for data, label, path in samples:
+            img = decode(data)
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, label, path
+
+
+def _shuffled(samples, buffer_size, rng):
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class ShardDataset(Dataset):
+    """
+    Map-style access to tar shards through their offset index: each item is
+    one positioned read in an already open shard, so it works with ordinary
+    shuffled DataLoaders and samplers.
+    """
+
+    classes = ManifestDataset.classes
+    class_to_idx = ManifestDataset.class_to_idx
+
+    def __init__(self, dirname, transform=None):
+        self.dirname = dirname
+        rows = read_manifest(os.path.join(dirname, 'index.csv'))
+        self.records = [(row['shard'], int(row['offset']), int(row['size'])) for row in rows]
+        self.samples = [(row['path'], int(row['label'])) for row in rows]
+        self.targets = [label for _, label in self.samples]
+        self.transform = transform
+        # Descriptors by (process id, shard). Forked DataLoader workers inherit
+        # the parent's, so each process opens its own, and reads use pread,
+        # which never moves a shared file offset.
+        self.fds = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fds'] = {}
+        return state
+
+    def read(self, index):
+        shard, offset, size = self.records[index]
+        key = (os.getpid(), shard)
+        if key not in self.fds:
+            self.fds[key] = os.open(os.path.join(self.dirname, shard), os.O_RDONLY)
+        return os.pread(self.fds[key], size, offset)
+
+    def __getitem__(self, index):
+        img = decode(self.read(index))
+        if self.transform is not None:
+            img = self.transform(img)
+        path, label = self.samples[index]
+        return img, label, path
+
+
+def _resize_crop(path):
+    with open(path, 'rb') as f:
+        return np.asarray(RESIZE_CROP(Image.open(f).convert('RGB')), dtype=np.uint8)
+
+
+def build_tensor_cache(manifest, out_dir, processes=None, chunksize=64):
+    """
+    Decode, resize and center crop every image of a split manifest once,
+    into out_dir/images.npy (N x 224 x 224 x 3 uint8, written through a
+    memory map), with labels.npy and paths.txt alongside.
+    """
+    rows = read_manifest(manifest)
+    paths = [row['path'] for row in rows]
+    os.makedirs(out_dir, exist_ok=True)
+
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(paths), 224, 224, 3))
+    with Pool(processes) as pool:
+        for i, image in enumerate(pool.imap(_resize_crop, paths, chunksize=chunksize)):
+            images[i] = image
+            if (i + 1) % 1000 == 0:
+                print(i + 1, 'of', len(paths))
+    images.flush()
+    del images
+
+    np.save(os.path.join(out_dir, 'labels.npy'),
+            np.array([int(row['label']) for row in rows], dtype=np.int64))
+    with open(os.path.join(out_dir, 'paths.txt'), 'w') as f:
+        f.write(''.join(path + '\n' for path in paths))
+    print(len(paths), "images cached in", out_dir)
+
+
+def normalize_batch(images, device=None):
+    """
+    uint8 N x H x W x C (or N x C x H x W) images to normalized float
+    N x C x H x W, as ToTensor and Normalize would, in one pass per batch.
+    """
+    if images.shape[-1] == 3:
+        images = images.permute(0, 3, 1, 2)
+    if device is not None:
+        # Copy the compact uint8 batch, not the float one
+        images = images.to(device, non_blocking=True)
+    mean = torch.tensor(MEAN, device=images.device).view(1, 3, 1, 1) * 255
+    std = torch.tensor(STD, device=images.device).view(1, 3, 1, 1) * 255
+    return (images.float() - mean) / std
+
+
+class TensorCacheDataset(Dataset):
+    """
+    Items (uint8 224 x 224 x 3 tensor, label, path) from a tensor cache.
+    Batches from a DataLoader go through normalize_batch before the model.
+    """
+
+    classes = ManifestDataset.classes
+    class_to_idx = ManifestDataset.class_to_idx
+
+    def __init__(self, dirname):
+        self.images = np.load(os.path.join(dirname, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(dirname, 'labels.npy'))
+        with open(os.path.join(dirname, 'paths.txt')) as f:
+            self.paths = f.read().splitlines()
+        self.samples = list(zip(self.paths, self.labels.tolist()))
+        self.targets = self.labels.tolist()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.images[index])), int(self.labels[index]), self.paths[index]
+
+    def batches(self, batch_size=256, device=None):
+        """
+        Normalized (images, labels, paths) batches in order, each read as one
+        contiguous slice of the cache, without a DataLoader.
+        """
+        for start in range(0, len(self), batch_size):
+            end = start + batch_size
+            images = torch.from_numpy(np.array(self.images[start:end]))
+            yield (normalize_batch(images, device),
+                   torch.from_numpy(self.labels[start:end]),
+                   self.paths[start:end])
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'pack':
+        split = sys.argv[2]
+        write_shards(split_path(split), shard_dir(split),
+                     int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
+
+    elif len(sys.argv) > 2 and sys.argv[1] == 'cache':
+        split = sys.argv[2]
+        build_tensor_cache(split_path(split), cache_dir(split))
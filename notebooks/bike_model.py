@@ -0,0 +1,87 @@
+import torch
+import wideresnet
+
+"""
+Building blocks of the bike classifier: the Places365 WideResNet-18
+backbone, the classification head of the final model, and the checkpoint
+format written by the Final Model notebook's save_checkpoint.
+"""
+
+PLACES365_WEIGHTS = 'wideresnet18_places365.pth.tar'
+
+CHECKPOINT = 'places365-transfer-final-v2.pth'
+
+FEATURE_SIZE = 512
+
+
+def load_places365(model_file=PLACES365_WEIGHTS, device='cpu'):
+    """ The pretrained Places365 WideResNet-18, frozen and in eval mode """
+    model = wideresnet.resnet18(num_classes=365)
+    checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage,
+                            weights_only=False)
+    state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
+    model.load_state_dict(state_dict)
+
+    for param in model.parameters():
+        param.requires_grad = False
+    return model.to(device).eval()
+
+
+def bike_head(n_inputs=FEATURE_SIZE, h=400, dropout=0.1, n_classes=2):
+    """ The fc head of the final model, outputting log probabilities """
+    return torch.nn.Sequential(
+        torch.nn.Linear(n_inputs, h),
+        torch.nn.LeakyReLU(negative_slope=0.01),
+        torch.nn.Dropout(dropout),
+        torch.nn.Linear(h, h),
+        torch.nn.LeakyReLU(negative_slope=0.01),
+        torch.nn.Dropout(dropout),
+        torch.nn.Linear(h, n_classes),
+        torch.nn.LogSoftmax(dim=1)
+    )
+
+
+def layer4_features(model, images):
+    """ The 512 x 14 x 14 last conv feature maps of a batch of normalized images """
+    x = model.relu(model.bn1(model.conv1(images)))
+    return model.layer4(model.layer3(model.layer2(model.layer1(x))))
+
+
+def backbone_features(model, images):
+    """ The 512-d avgpool embeddings of a batch of normalized images """
+    x = layer4_features(model, images)
+    return model.avgpool(x).view(x.size(0), -1)
+
+
+def load_classifier(path=CHECKPOINT, device='cpu'):
+    """
+    The fine-tuned classifier from a checkpoint, in eval mode. The
+    checkpoint's state_dict already holds the backbone weights, so the
+    Places365 weights aren't read, and any saved optimizer is ignored.
+    """
+    # A trusted local file that pickles the fc module, not just tensors
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage, weights_only=False)
+    model = wideresnet.resnet18(num_classes=365)
+    model.fc = checkpoint['fc']
+    model.load_state_dict(checkpoint['state_dict'])
+    model.class_to_idx = checkpoint['class_to_idx']
+    model.idx_to_class = checkpoint['idx_to_class']
+
+    for param in model.parameters():
+        param.requires_grad = False
+    return model.to(device).eval()
+
+
+def save_checkpoint(model, path, optimizer=None):
+    """ Save a model with its head in the notebook's checkpoint format """
+    checkpoint = {
+        'class_to_idx': model.class_to_idx,
+        'idx_to_class': model.idx_to_class,
+        'epochs': model.epochs,
+        'fc': model.fc,
+        'state_dict': model.state_dict(),
+    }
+    if optimizer is not None:
+        checkpoint['optimizer'] = optimizer
+        checkpoint['optimizer_state_dict'] = optimizer.state_dict()
+    torch.save(checkpoint, path)
@@ -0,0 +1,127 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import cv2
+import torch
+from torch.nn import functional as F
+from torch.utils.data import DataLoader
+import bike_data
+import bike_model
+import predict
+
+"""
+Class activation maps for whole batches of images. For a linear head (like
+the Places365 fc) the maps of every image and every requested class come
+from one tensor contraction of the head weights with the layer4 feature
+maps. Other heads, like the bike classifier's MLP, are applied at each of
+the 14 x 14 locations instead. The result is the same CAM for a linear
+head, and a spatial class score map otherwise. The maps are normalized
+and upsampled on the tensor, and the overlay images are written by a
+thread pool.
+
+    python cam.py ../data/splits/test.csv ../data/cams/ --limit 1000
+"""
+
+
+def _scoring_head(head):
+    """ A head without a trailing LogSoftmax, so it gives raw class scores """
+    if isinstance(head, torch.nn.Sequential) and isinstance(head[-1], torch.nn.LogSoftmax):
+        return head[:-1]
+    return head
+
+
+def class_activation_maps(features, head, class_idx, size=(224, 224)):
+    """
+    uint8 CAMs (N x K x size) for layer4 features (N x C x h x w) and class
+    indices: a list of K classes for every image, or an N x K tensor of
+    classes per image.
+    """
+    n, c, h, w = features.shape
+    class_idx = torch.as_tensor(class_idx, device=features.device)
+    if class_idx.dim() == 1:
+        class_idx = class_idx.expand(n, -1)
+
+    head = _scoring_head(head)
+    if isinstance(head, torch.nn.Linear):
+        weights = head.weight[class_idx]                      # N x K x C
+        cams = torch.einsum('nkc,nchw->nkhw', weights, features)
+    else:
+        scores = head(features.permute(0, 2, 3, 1).reshape(n * h * w, c))
+        scores = scores.reshape(n, h, w, -1).permute(0, 3, 1, 2)   # N x classes x h x w
+        cams = scores.gather(1, class_idx[:, :, None, None].expand(-1, -1, h, w))
+
+    flat = cams.flatten(2)
+    flat = flat - flat.min(dim=2, keepdim=True)[0]
+    flat = flat / flat.max(dim=2, keepdim=True)[0].clamp(min=1e-12)
+    cams = F.interpolate(flat.view_as(cams), size=size, mode='bilinear', align_corners=False)
+    return (255 * cams.clamp(0, 1)).to(torch.uint8)
+
+
+def batch_cams(model, images, class_idx=None, size=(224, 224)):
+    """
+    Predictions and CAMs for a batch of normalized images, from one forward
+    pass. With no class_idx, each image's map is for its predicted class.
+    Returns (log probabilities, N x K x size uint8 CAMs).
+    """
+    with torch.inference_mode(), model.capture_features(['layer4']) as captured:
+        output = model(images)
+        features = captured[0]['layer4']
+        if class_idx is None:
+            class_idx = output.argmax(dim=1, keepdim=True)
+        return output, class_activation_maps(features, model.fc, class_idx, size)
+
+
+def write_overlay(cam, image_path, out_path):
+    """ Blend a heatmap of a uint8 CAM onto its original image, as the places365 demo does """
+    img = cv2.imread(image_path)
+    height, width, _ = img.shape
+    heatmap = cv2.applyColorMap(cv2.resize(cam, (width, height)), cv2.COLORMAP_JET)
+    cv2.imwrite(out_path, heatmap * 0.4 + img * 0.5)
+
+
+def write_overlays(cams, paths, out_dir, pool):
+    """ Queue overlays of each image's first CAM on a thread pool; returns the futures """
+    os.makedirs(out_dir, exist_ok=True)
+    cams = cams[:, 0].cpu().numpy()
+    return [pool.submit(write_overlay, cam, path, os.path.join(out_dir, os.path.basename(path)))
+            for cam, path in zip(cams, paths)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write CAM overlays for the bike classifier.")
+    parser.add_argument('source', help="image directory or split manifest")
+    parser.add_argument('out_dir')
+    parser.add_argument('--checkpoint', default=bike_model.CHECKPOINT)
+    parser.add_argument('--class', dest='class_', type=int, default=None,
+                        help="class to explain (default: each image's prediction)")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+    # Overlays re-read each original image from its path, which shard samples don't have
+    if os.path.isdir(args.source) and bike_data.shard_filenames(args.source):
+        parser.error("shard directories aren't supported; pass an image directory or manifest")
+
+    model = bike_model.load_classifier(args.checkpoint)
+    dataset = predict.image_dataset(args.source)
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers)
+    class_idx = None if args.class_ is None else [args.class_]
+
+    n = 0
+    with ThreadPoolExecutor(args.writers) as pool:
+        futures = []
+        for images, _, paths in loader:
+            _, cams = batch_cams(model, images, class_idx)
+            futures += write_overlays(cams, paths, args.out_dir, pool)
+            n += len(paths)
+            if args.limit and n >= args.limit:
+                break
+        for future in futures:
+            future.result()
+    print(n, "CAM overlays saved to", args.out_dir)
+
+
+if __name__ == '__main__':
+
+    main()
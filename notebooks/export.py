@@ -0,0 +1,77 @@
+import argparse
+import json
+import numpy as np
+import torch
+import bike_model
+import runtime
+
+"""
+Export the fine-tuned classifier (backbone and head, without the optimizer)
+as a single self-contained artifact for runtime.py: a frozen TorchScript
+module (.ts) or an ONNX graph (.onnx), each carrying its class_to_idx. Each
+artifact is loaded back with runtime.load and checked against the eager model.
+
+    python export.py bike-classifier.ts
+    python export.py bike-classifier.onnx
+"""
+
+
+def example_input(batch_size=1):
+    return torch.randn(batch_size, 3, 224, 224)
+
+
+def export_torchscript(model, path):
+    """
+    Trace, freeze and save the model, with class_to_idx as an extra file.
+    The module is saved before optimize_for_inference, whose graphs can't be
+    loaded back; runtime.load_torchscript applies it after loading instead.
+    """
+    traced = torch.jit.trace(model, example_input())
+    frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path,
+                   _extra_files={'class_to_idx.json': json.dumps(model.class_to_idx)})
+
+
+def export_onnx(model, path, opset_version=13):
+    """ Save the model as ONNX with a variable batch size and class_to_idx as metadata """
+    import onnx
+
+    torch.onnx.export(model, example_input(), path,
+                      input_names=['images'], output_names=['log_probabilities'],
+                      dynamic_axes={'images': {0: 'batch'}, 'log_probabilities': {0: 'batch'}},
+                      opset_version=opset_version)
+
+    graph = onnx.load(path)
+    entry = graph.metadata_props.add()
+    entry.key = 'class_to_idx'
+    entry.value = json.dumps(model.class_to_idx)
+    onnx.save(graph, path)
+
+
+def check_export(model, path, batch_size=4, atol=1e-4):
+    """ Load an artifact with runtime.load and compare its output to the eager model's """
+    images = example_input(batch_size)
+    with torch.inference_mode():
+        expected = model(images).numpy()
+    actual = runtime.load(path)(images.numpy())
+    actual = actual.cpu().numpy() if hasattr(actual, 'cpu') else actual
+    np.testing.assert_allclose(actual, expected, atol=atol)
+
+
+def export(checkpoint, path):
+    model = bike_model.load_classifier(checkpoint)
+    if path.endswith('.onnx'):
+        export_onnx(model, path)
+    else:
+        export_torchscript(model, path)
+    check_export(model, path)
+    print(path, "saved and checked against the eager model.")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Export the bike classifier for runtime.py.")
+    parser.add_argument('output', help="a .ts (TorchScript) or .onnx path")
+    parser.add_argument('--checkpoint', default=bike_model.CHECKPOINT)
+    args = parser.parse_args()
+    export(args.checkpoint, args.output)
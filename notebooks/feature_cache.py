@@ -0,0 +1,169 @@
+import os
+import sys
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+import bike_data
+import bike_model
+
+"""
+Train the classifier head on cached backbone features. The Places365
+backbone is frozen, so its 512-d avgpool embedding of each image only needs
+computing once. extract_features stores the embeddings of a split, for
+variant 0 with the deterministic val transform and for each further
+variant with one fixed draw of the training augmentation. train_head then
+trains the head for many epochs on those embeddings alone.
+
+The backbone runs in eval mode here. The notebook's train() put the whole
+model in train mode, so its BatchNorm layers used batch statistics.
+
+    python feature_cache.py extract train 5
+    python feature_cache.py extract val
+    python feature_cache.py train
+"""
+
+FEATURE_DIR = '../data/features/'
+
+
+def feature_dir(split, root=FEATURE_DIR):
+    return os.path.join(root, split)
+
+
+def extract_features(model, manifest, out_dir, variants=1, batch_size=128,
+                     num_workers=4, device='cpu'):
+    """
+    Write out_dir/features.npy (variants x N x 512 float32), labels.npy and
+    paths.txt for the images of a split manifest. Variant v > 0 is
+    augmented with random seed v, so reruns give the same features.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    dataset = bike_data.ManifestDataset(manifest)
+    features = np.lib.format.open_memmap(
+        os.path.join(out_dir, 'features.npy'), mode='w+', dtype=np.float32,
+        shape=(variants, len(dataset), bike_model.FEATURE_SIZE))
+
+    for variant in range(variants):
+        start = timer()
+        dataset.transform = bike_data.TRAIN_TRANSFORM if variant else bike_data.EVAL_TRANSFORM
+        torch.manual_seed(variant)
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+        i = 0
+        with torch.no_grad():
+            for images, _, _ in loader:
+                embeddings = bike_model.backbone_features(model, images.to(device))
+                features[variant, i:i + len(embeddings)] = embeddings.cpu().numpy()
+                i += len(embeddings)
+        print(f'Variant {variant}: {len(dataset)} images in {timer() - start:.2f} seconds.')
+
+    features.flush()
+    np.save(os.path.join(out_dir, 'labels.npy'), np.array(dataset.targets, dtype=np.int64))
+    with open(os.path.join(out_dir, 'paths.txt'), 'w') as f:
+        f.write(''.join(path + '\n' for path, _ in dataset.samples))
+
+
+def load_features(dirname):
+    """ (features, labels, paths) from a feature cache, features loaded whole """
+    features = torch.from_numpy(np.load(os.path.join(dirname, 'features.npy')))
+    labels = torch.from_numpy(np.load(os.path.join(dirname, 'labels.npy')))
+    with open(os.path.join(dirname, 'paths.txt')) as f:
+        paths = f.read().splitlines()
+    return features, labels, paths
+
+
+def train_head(head, train_dir, valid_dir, lr=.1, weight_decay=1e-5, criterion=None,
+               batch_size=128, n_epochs=100, max_epochs_stop=10, print_every=5):
+    """
+    Train a head on cached features, with the notebook's optimizer, loss and
+    early stopping on validation loss. Each epoch, every training image uses
+    a randomly chosen one of its cached variants. Returns the head with the
+    best validation loss (or as trained, if no epoch improved on it), its
+    optimizer and a history DataFrame like train()'s.
+    """
+    train_x, train_y, _ = load_features(train_dir)
+    valid_x, valid_y, _ = load_features(valid_dir)
+    valid_x = valid_x[0]
+    criterion = criterion or torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(head.parameters(), lr=lr, momentum=0.9,
+                                weight_decay=weight_decay)
+
+    history = []
+    best_state, valid_loss_min, epochs_no_improve = None, np.inf, 0
+    epoch = -1
+    overall_start = timer()
+
+    for epoch in range(n_epochs):
+        head.train()
+        variant = torch.randint(len(train_x), (len(train_y),))
+        order = torch.randperm(len(train_y))
+        train_loss = train_correct = 0.0
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            x, y = train_x[variant[batch], batch], train_y[batch]
+            optimizer.zero_grad()
+            output = head(x)
+            loss = criterion(output, y)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item() * len(batch)
+            train_correct += (output.argmax(dim=1) == y).sum().item()
+
+        head.eval()
+        with torch.no_grad():
+            output = head(valid_x)
+            valid_loss = criterion(output, valid_y).item()
+            valid_acc = (output.argmax(dim=1) == valid_y).float().mean().item()
+
+        train_loss /= len(train_y)
+        train_acc = train_correct / len(train_y)
+        history.append([train_loss, valid_loss, train_acc, valid_acc])
+
+        if (epoch + 1) % print_every == 0:
+            print(f'Epoch: {epoch} \tTraining Loss: {train_loss:.4f} \tValidation Loss: {valid_loss:.4f}')
+            print(f'\t\tTraining Accuracy: {100 * train_acc:.2f}%\t Validation Accuracy: {100 * valid_acc:.2f}%')
+
+        if valid_loss < valid_loss_min:
+            best_state = {k: v.clone() for k, v in head.state_dict().items()}
+            valid_loss_min, epochs_no_improve = valid_loss, 0
+        else:
+            epochs_no_improve += 1
+            if epochs_no_improve >= max_epochs_stop:
+                print(f'Early Stopping! Total epochs: {epoch}.')
+                break
+
+    total_time = timer() - overall_start
+    print(f'{total_time:.2f} total seconds elapsed. {total_time / max(epoch + 1, 1):.2f} seconds per epoch.')
+    if best_state is not None:
+        head.load_state_dict(best_state)
+    head.epochs = epoch + 1
+    history = pd.DataFrame(history, columns=['train_loss', 'valid_loss', 'train_acc', 'valid_acc'])
+    return head, optimizer, history
+
+
+def attach_head(model, head):
+    """ The backbone with a trained head as its fc, ready for save_checkpoint """
+    model.fc = head
+    model.class_to_idx = bike_data.ManifestDataset.class_to_idx
+    model.idx_to_class = {idx: class_ for class_, idx in model.class_to_idx.items()}
+    model.epochs = getattr(head, 'epochs', 0)
+    return model
+
+
+if __name__ == '__main__':
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'extract':
+        split = sys.argv[2]
+        extract_features(bike_model.load_places365(device=device),
+                         bike_data.split_path(split), feature_dir(split),
+                         variants=int(sys.argv[3]) if len(sys.argv) > 3 else 1, device=device)
+
+    elif len(sys.argv) > 1 and sys.argv[1] == 'train':
+        head, optimizer, history = train_head(bike_model.bike_head(),
+                                              feature_dir('train'), feature_dir('val'))
+        model = attach_head(bike_model.load_places365(), head)
+        bike_model.save_checkpoint(model, bike_model.CHECKPOINT, optimizer)
+        history.to_csv('final_history.csv')
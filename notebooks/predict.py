@@ -0,0 +1,167 @@
+import argparse
+import csv
+import io
+import os
+from multiprocessing import Pool
+from timeit import default_timer as timer
+import numpy as np
+from PIL import Image
+import runtime
+
+"""
+Classify many street images with the fine-tuned bike classifier. Images
+come from a directory of .jpg files, a split manifest (.csv) or a directory
+of tar shards, are decoded by worker processes, and scored in batches.
+Writes one row per image (path, way_id, probability, prediction, label) to
+CSV, or to Parquet if the output ends in .parquet.
+
+    python predict.py ../data/images/ predictions.csv --workers 4 --threads 8
+
+With --model, an artifact from export.py is loaded through runtime.py and
+images are preprocessed by runtime.preprocess, so neither torchvision nor
+the model code is imported. Otherwise the network is rebuilt from the
+training checkpoint and fed by a torch DataLoader.
+"""
+
+
+def list_images(source):
+    """
+    (location, label, path) for every image of a directory, split manifest
+    or shard directory. location is a file path, or (shard, offset, size)
+    for an image inside a tar shard.
+    """
+    if os.path.isdir(source) and os.path.exists(os.path.join(source, 'index.csv')):
+        with open(os.path.join(source, 'index.csv'), newline='') as f:
+            return [((os.path.join(source, row['shard']), int(row['offset']), int(row['size'])),
+                     int(row['label']), row['path']) for row in csv.DictReader(f)]
+    if os.path.isdir(source):
+        paths = sorted(entry.path for entry in os.scandir(source)
+                       if entry.is_file() and entry.name.endswith('.jpg'))
+        return [(path, -1, path) for path in paths]
+    with open(source, newline='') as f:
+        return [(row['path'], int(row['label']), row['path']) for row in csv.DictReader(f)]
+
+
+def _read(location):
+    if isinstance(location, str):
+        with open(location, 'rb') as f:
+            return f.read()
+    shard, offset, size = location
+    with open(shard, 'rb') as f:
+        return os.pread(f.fileno(), size, offset)
+
+
+def _preprocess_batch(items):
+    batch = np.empty((len(items), 3, 224, 224), dtype=np.float32)
+    for i, (location, _, _) in enumerate(items):
+        batch[i] = runtime.preprocess(Image.open(io.BytesIO(_read(location))))
+    return batch, items
+
+
+def predict(model, items, batch_size=64, num_workers=4):
+    """
+    Yield (path, way_id, probability, prediction, label) for every image,
+    where probability is the model's probability of a bike-friendly street.
+    model is a runtime.Classifier; items come from list_images.
+    """
+    chunks = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    pool = Pool(num_workers) if num_workers > 0 else None
+    try:
+        batches = pool.imap(_preprocess_batch, chunks) if pool else map(_preprocess_batch, chunks)
+        for batch, batch_items in batches:
+            probabilities = model.probabilities(batch)
+            for (_, label, path), probability in zip(batch_items, probabilities.tolist()):
+                yield (path, runtime.image_way_id(path), probability,
+                       int(probability >= 0.5), label)
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def image_dataset(source, transform=None):
+    """ A torch dataset for a directory of images, a split manifest or a shard directory """
+    import bike_data
+
+    transform = transform or bike_data.EVAL_TRANSFORM
+    if os.path.isdir(source) and bike_data.shard_filenames(source):
+        return bike_data.ShardIterableDataset(source, transform)
+    if os.path.isdir(source):
+        return bike_data.ImageListDataset.from_directory(source, transform)
+    return bike_data.ManifestDataset(source, transform)
+
+
+def predict_checkpoint(model, dataset, batch_size=64, num_workers=4, device='cpu'):
+    """ predict() for a model from bike_model.load_classifier, fed by a DataLoader """
+    import torch
+    from torch.utils.data import DataLoader
+
+    positive = model.class_to_idx['1']
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                        pin_memory=device != 'cpu')
+
+    with torch.inference_mode():
+        for images, labels, paths in loader:
+            probabilities = model(images.to(device)).exp()[:, positive].cpu()
+            for path, probability, label in zip(paths, probabilities.tolist(), labels.tolist()):
+                yield (path, runtime.image_way_id(path), probability,
+                       int(probability >= 0.5), label)
+
+
+def write_predictions(rows, filename):
+    """ Write prediction rows as they come (CSV) or all at once (Parquet) """
+    columns = ['path', 'way_id', 'probability', 'prediction', 'label']
+    n = 0
+    if filename.endswith('.parquet'):
+        import pandas as pd
+        rows = list(rows)
+        pd.DataFrame(rows, columns=columns).to_parquet(filename, index=False)
+        n = len(rows)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                n += 1
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify street images in batches.")
+    parser.add_argument('source', help="image directory, split manifest or shard directory")
+    parser.add_argument('output', help="predictions .csv or .parquet")
+    parser.add_argument('--model', help="a .ts or .onnx artifact from export.py")
+    parser.add_argument('--checkpoint', default='places365-transfer-final-v2.pth',
+                        help="training checkpoint, used when no --model is given")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4, help="decoding processes")
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads")
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    start = timer()
+    if args.model:
+        model = runtime.load(args.model, args.device, args.threads)
+    else:
+        import torch
+        import bike_model
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        model = bike_model.load_classifier(args.checkpoint, args.device)
+    loaded = timer()
+    print(f'Model loaded in {loaded - start:.2f} seconds.')
+
+    if args.model:
+        rows = predict(model, list_images(args.source), args.batch_size, args.workers)
+    else:
+        rows = predict_checkpoint(model, image_dataset(args.source), args.batch_size,
+                                  args.workers, args.device)
+    n = write_predictions(rows, args.output)
+    elapsed = timer() - loaded
+    print(f'{n} images in {elapsed:.2f} seconds, {n / max(elapsed, 1e-9):.1f} images/sec.')
+    print(args.output, "saved.")
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import copy
+import json
+import os
+from timeit import default_timer as timer
+import torch
+from torch.utils.data import DataLoader
+import bike_data
+import bike_model
+
+"""
+Post-training static INT8 quantization of the bike classifier for CPU
+scoring. The backbone's Conv-BN-ReLU sequences are fused, and activation
+ranges are calibrated on the val split. The backbone is then converted to
+int8, while the small fc head stays in fp32. The quantized model is saved
+as TorchScript, after printing accuracy and latency next to the fp32 model.
+
+    python quantize.py --calibration-batches 20
+"""
+
+QUANTIZED_MODEL = 'places365-transfer-final-v2-int8.pt'
+
+
+class QuantizableClassifier(torch.nn.Module):
+    """ Quantized backbone between Quant/DeQuant stubs, followed by the float head """
+
+    def __init__(self, model):
+        super(QuantizableClassifier, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.fc = model.fc
+        self.fc.qconfig = None
+        model.fc = torch.nn.Identity()
+        self.backbone = model
+        self.dequant = torch.quantization.DeQuantStub()
+        self.class_to_idx = model.class_to_idx
+
+    def forward(self, x):
+        x = self.dequant(self.backbone(self.quant(x)))
+        return self.fc(x)
+
+
+def quantize(model, calibration_loader, batches=20, backend='fbgemm'):
+    """
+    An int8 copy of an fp32 classifier, calibrated on up to `batches`
+    batches of (image, label, path) from calibration_loader.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    model.fuse_model()
+
+    qmodel = QuantizableClassifier(model).eval()
+    qmodel.qconfig = torch.quantization.get_default_qconfig(backend)
+    qmodel.fc.qconfig = None
+    torch.quantization.prepare(qmodel, inplace=True)
+
+    with torch.inference_mode():
+        for i, (images, _, _) in enumerate(calibration_loader):
+            if i == batches:
+                break
+            qmodel(images)
+
+    return torch.quantization.convert(qmodel, inplace=True)
+
+
+def accuracy(model, loader):
+    correct = total = 0
+    with torch.inference_mode():
+        for images, labels, _ in loader:
+            correct += (model(images).argmax(dim=1) == labels).sum().item()
+            total += len(labels)
+    return correct / total
+
+
+def latency(model, batch_size, repeats=10):
+    """ Seconds per image at a batch size, after a warmup batch """
+    images = torch.randn(batch_size, 3, 224, 224)
+    with torch.inference_mode():
+        model(images)
+        start = timer()
+        for _ in range(repeats):
+            model(images)
+    return (timer() - start) / (repeats * batch_size)
+
+
+def compare(models, loader, batch_sizes=(1, 32)):
+    """ Print accuracy and per-image latency for a dict of named models """
+    print('{:<8}{:>10}'.format('model', 'accuracy') +
+          ''.join('{:>14}'.format('ms/img @{}'.format(b)) for b in batch_sizes))
+    for name, model in models.items():
+        print('{:<8}{:>9.2%} '.format(name, accuracy(model, loader)) +
+              ''.join('{:>14.2f}'.format(1000 * latency(model, b)) for b in batch_sizes))
+
+
+def save_quantized(qmodel, path=QUANTIZED_MODEL):
+    """ Save a quantized model as TorchScript, loadable with runtime.load like export.py's """
+    traced = torch.jit.trace(qmodel, torch.randn(1, 3, 224, 224))
+    torch.jit.save(traced, path,
+                   _extra_files={'class_to_idx.json': json.dumps(qmodel.class_to_idx)})
+    print(path, "saved,", os.path.getsize(path) // 2**20, "MB.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the bike classifier to int8.")
+    parser.add_argument('--checkpoint', default=bike_model.CHECKPOINT)
+    parser.add_argument('--output', default=QUANTIZED_MODEL)
+    parser.add_argument('--calibration-batches', type=int, default=20)
+    parser.add_argument('--eval-split', default='test')
+    parser.add_argument('--backend', default='fbgemm', help="fbgemm (x86) or qnnpack (ARM)")
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    model = bike_model.load_classifier(args.checkpoint)
+
+    calibration = bike_data.ManifestDataset(bike_data.split_path('val'), bike_data.EVAL_TRANSFORM)
+    qmodel = quantize(model, DataLoader(calibration, batch_size=32, shuffle=True,
+                                        num_workers=args.workers),
+                      args.calibration_batches, args.backend)
+
+    evaluation = bike_data.ManifestDataset(bike_data.split_path(args.eval_split),
+                                           bike_data.EVAL_TRANSFORM)
+    compare({'fp32': model, 'int8': qmodel},
+            DataLoader(evaluation, batch_size=64, num_workers=args.workers))
+    save_quantized(qmodel, args.output)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,129 @@
+import json
+import os
+import numpy as np
+from PIL import Image
+
+"""
+Minimal loader for classifiers exported by export.py, for short-lived
+scoring workers. It needs neither torchvision nor the model code or
+Places365 weights: TorchScript artifacts need only torch, and ONNX artifacts
+need only onnxruntime.
+
+    model = runtime.load('bike-classifier.onnx')
+    probabilities = model.probabilities(runtime.preprocess_files(paths))
+"""
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def image_way_id(path):
+    """
+    Way id of an image named w<way>_n<node>...jpg, or -1. This is a copy of
+    scripts/label_index.py's image_way_id, kept here so runtime.py stays
+    dependency-free; change both together.
+    """
+    try:
+        return int(os.path.basename(path).split('_')[0][1:])
+    except ValueError:
+        return -1
+
+
+class Classifier(object):
+    """
+    An exported classifier. Called on an N x 3 x 224 x 224 batch (torch
+    tensor or numpy array), returns log probabilities of the same kind.
+    """
+
+    def __init__(self, run, class_to_idx):
+        self.run = run
+        self.class_to_idx = class_to_idx
+
+    def __call__(self, images):
+        return self.run(images)
+
+    def probabilities(self, images, class_='1'):
+        """ Probability of class_ (bike-friendly by default) for each image, as numpy """
+        output = self(images)
+        output = output.cpu().numpy() if hasattr(output, 'cpu') else output
+        return np.exp(output[:, self.class_to_idx[class_]])
+
+
+def from_module(module, class_to_idx, device='cpu'):
+    """ A Classifier around a loaded torch module """
+    import torch
+
+    def run(images):
+        if isinstance(images, np.ndarray):
+            images = torch.from_numpy(images)
+        with torch.inference_mode():
+            return module(images.to(device))
+
+    return Classifier(run, class_to_idx)
+
+
+def load_torchscript(path, device='cpu', threads=None):
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    extra_files = {'class_to_idx.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    module = torch.jit.optimize_for_inference(module.eval())
+    return from_module(module, json.loads(extra_files['class_to_idx.json']), device)
+
+
+def load_onnx(path, threads=None):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    class_to_idx = json.loads(session.get_modelmeta().custom_metadata_map['class_to_idx'])
+
+    def run(images):
+        if isinstance(images, np.ndarray):
+            return session.run(None, {'images': images})[0]
+        # A torch tensor in, a torch tensor out
+        import torch
+        return torch.from_numpy(session.run(None, {'images': images.cpu().numpy()})[0])
+
+    return Classifier(run, class_to_idx)
+
+
+def load(path, device='cpu', threads=None):
+    """ Load a .ts or .onnx classifier from export.py """
+    if path.endswith('.onnx'):
+        return load_onnx(path, threads)
+    return load_torchscript(path, device, threads)
+
+
+def preprocess(img):
+    """
+    The eval transform (Resize(256), CenterCrop(224), ToTensor, Normalize)
+    with PIL and numpy: a PIL image to a 3 x 224 x 224 float32 array.
+    """
+    img = img.convert('RGB')
+    w, h = img.size
+    if w <= h:
+        size = (256, int(256 * h / w))
+    else:
+        size = (int(256 * w / h), 256)
+    img = img.resize(size, Image.BILINEAR)
+
+    left = int(round((size[0] - 224) / 2.0))
+    top = int(round((size[1] - 224) / 2.0))
+    img = img.crop((left, top, left + 224, top + 224))
+
+    x = (np.asarray(img, dtype=np.float32) / 255 - MEAN) / STD
+    return x.transpose(2, 0, 1)
+
+
+def preprocess_files(paths):
+    """ A preprocessed N x 3 x 224 x 224 batch from image files """
+    batch = np.empty((len(paths), 3, 224, 224), dtype=np.float32)
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            batch[i] = preprocess(Image.open(f))
+    return batch
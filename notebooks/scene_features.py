@@ -0,0 +1,105 @@
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import bike_data
+import bike_model
+import feature_cache
+
+"""
+Scene features for every image of a split, from the cached 512-d avgpool
+embeddings of feature_cache.py instead of new CNN passes:
+
+    - the 102 SUN scene attribute scores (W_sceneattribute . embedding)
+    - the top-k Places365 categories and their probabilities, from the
+      original Places365 fc layer
+    - the indoor/outdoor score: the mean IO label of the top 10 categories
+      (0 indoor, 1 outdoor), as in run_placesCNN_unified.py
+
+Each is one matrix product over the whole split. The table is written
+next to predictions from predict.py and can be merged with them by path.
+
+    python scene_features.py test scene_test.parquet --predictions predictions.csv
+"""
+
+W_ATTRIBUTE = 'W_sceneattribute_wideresnet18.npy'
+
+
+def load_scene_labels():
+    """ Places365 category names, their IO labels (0 indoor, 1 outdoor) and SUN attribute names """
+    with open('categories_places365.txt') as f:
+        categories = [line.strip().split(' ')[0][3:] for line in f]
+    with open('IO_places365.txt') as f:
+        labels_io = np.array([int(line.rstrip().split()[-1]) - 1 for line in f])
+    with open('labels_sunattribute.txt') as f:
+        attributes = [line.rstrip() for line in f]
+    return categories, labels_io, attributes
+
+
+def places365_fc(model_file=bike_model.PLACES365_WEIGHTS):
+    """ Weight (365 x 512) and bias of the original Places365 classifier """
+    checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage,
+                            weights_only=False)
+    state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
+    return state_dict['fc.weight'].numpy(), state_dict['fc.bias'].numpy()
+
+
+def scene_features(embeddings, fc_weight, fc_bias, w_attribute, labels_io, k=5):
+    """
+    For N x 512 embeddings: N x 102 attribute scores, N x k top category
+    indices and probabilities, and N IO scores.
+    """
+    attributes = embeddings @ w_attribute.T
+
+    logits = embeddings @ fc_weight.T + fc_bias
+    logits -= logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+    top = np.argsort(-probabilities, axis=1)[:, :max(k, 10)]
+    io = labels_io[top[:, :10]].mean(axis=1)
+    top = top[:, :k]
+    return attributes, top, np.take_along_axis(probabilities, top, axis=1), io
+
+
+def scene_table(dirname, k=5, model_file=bike_model.PLACES365_WEIGHTS):
+    """ A DataFrame of scene features for the images of a feature cache, one row per image """
+    features, _, paths = feature_cache.load_features(dirname)
+    categories, labels_io, attribute_names = load_scene_labels()
+    fc_weight, fc_bias = places365_fc(model_file)
+
+    attributes, top, top_probabilities, io = scene_features(
+        features[0].numpy(), fc_weight, fc_bias, np.load(W_ATTRIBUTE), labels_io, k)
+
+    table = pd.DataFrame({'path': paths,
+                          'way_id': [bike_data.image_way_id(p) for p in paths],
+                          'io_score': io})
+    for i in range(k):
+        table['category_{}'.format(i + 1)] = np.array(categories)[top[:, i]]
+        table['category_{}_probability'.format(i + 1)] = top_probabilities[:, i]
+    attributes = pd.DataFrame(attributes, columns=['attribute_' + a for a in attribute_names])
+    return pd.concat([table, attributes], axis=1)
+
+
+def write_table(table, filename):
+    if filename.endswith('.parquet'):
+        table.to_parquet(filename, index=False)
+    else:
+        table.to_csv(filename, index=False)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Scene features from cached embeddings.")
+    parser.add_argument('split', help="a split with cached features (feature_cache.py extract)")
+    parser.add_argument('output', help="scene features .csv or .parquet")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--predictions', help="predictions from predict.py to merge in by path")
+    args = parser.parse_args()
+
+    table = scene_table(feature_cache.feature_dir(args.split), args.top_k)
+    if args.predictions:
+        read = pd.read_parquet if args.predictions.endswith('.parquet') else pd.read_csv
+        table = read(args.predictions).merge(table.drop(columns='way_id'), on='path', how='left')
+    write_table(table, args.output)
+    print(args.output, "saved with", len(table), "images.")
@@ -0,0 +1,191 @@
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import collections
+import io
+import json
+import queue
+import threading
+from timeit import default_timer as timer
+import numpy as np
+from PIL import Image
+import runtime
+
+"""
+Local HTTP scoring service for street images. The classifier stays loaded,
+and concurrent requests are coalesced into micro-batches. A batch runs
+once it has max_batch_size images, or once its first image has waited
+max_latency seconds.
+
+    POST /predict     body: one JPEG  ->  {"probability": 0.93, "prediction": 1}
+    GET  /metrics     throughput, batch sizes and latency percentiles
+
+    python serve.py bike-classifier.onnx --port 8080 --max-batch-size 32 --max-latency 0.01
+"""
+
+
+class Metrics(object):
+    """ Request counts and recent latencies, safe to update from many threads """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start = timer()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=window)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(size)
+
+    def record_request(self, latency, ok=True):
+        with self.lock:
+            self.requests += 1
+            self.errors += not ok
+            self.latencies.append(latency)
+
+    def summary(self, queue_depth=0):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = timer() - self.start
+            summary = {
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'images_per_second': self.requests / elapsed if elapsed else 0.0,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'queue_depth': queue_depth,
+            }
+        for p in [50, 95, 99]:
+            summary['latency_p{}_ms'.format(p)] = (
+                float(np.percentile(latencies, p)) * 1000 if len(latencies) else 0.0)
+        return summary
+
+
+class MicroBatcher(object):
+    """
+    Collects single images from many threads into batches for one model
+    thread. submit() returns a Future of the image's probability.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_latency=0.01, metrics=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = metrics or Metrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """ Queue one preprocessed 3 x 224 x 224 image """
+        future = Future()
+        self.queue.put((image, future))
+        return future
+
+    def _next_batch(self):
+        # Block for the first image, then wait at most max_latency for more
+        batch = [self.queue.get()]
+        deadline = timer() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - timer()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            futures = [future for _, future in batch]
+            try:
+                probabilities = self.model.probabilities(np.stack([image for image, _ in batch]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(batch))
+            for future, probability in zip(futures, probabilities.tolist()):
+                future.set_result(probability)
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+
+    batcher = None
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+
+        start = timer()
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image = runtime.preprocess(Image.open(io.BytesIO(body)))
+        except Exception:
+            self.batcher.metrics.record_request(timer() - start, ok=False)
+            self.send_error(400, "Body must be an image")
+            return
+
+        try:
+            probability = self.batcher.submit(image).result()
+        except Exception as e:
+            self.batcher.metrics.record_request(timer() - start, ok=False)
+            self.send_error(500, repr(e))
+            return
+        self.batcher.metrics.record_request(timer() - start)
+        self._send_json({'probability': probability, 'prediction': int(probability >= 0.5)})
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send_json(self.batcher.metrics.summary(self.batcher.queue.qsize()))
+        else:
+            self.send_error(404)
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(model, host='127.0.0.1', port=0, max_batch_size=32, max_latency=0.01):
+    batcher = MicroBatcher(model, max_batch_size, max_latency)
+    handler = type('Handler', (ScoringHandler,), {'batcher': batcher})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start(model, host='127.0.0.1', port=0, max_batch_size=32, max_latency=0.01):
+    """ Serve a loaded classifier in a background thread. Call .shutdown() to stop it """
+    server = make_server(model, host, port, max_batch_size, max_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve the bike classifier over HTTP.")
+    parser.add_argument('model', help="a .ts or .onnx artifact from export.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-latency', type=float, default=0.01, help="seconds")
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    server = make_server(runtime.load(args.model, threads=args.threads), args.host, args.port,
+                         args.max_batch_size, args.max_latency)
+    print("Serving the bike classifier on http://{}:{}/predict".format(*server.server_address))
+    server.serve_forever()
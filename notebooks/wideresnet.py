@@ -1,5 +1,8 @@
 import torch.nn as nn
 import math
+import threading
+from contextlib import contextmanager
+from torch.quantization import fuse_modules
 import torch.utils.model_zoo as model_zoo
 
 
@@ -7,6 +10,9 @@ __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
            'resnet152']
 
 
+# Per-thread stack of active feature captures, see ResNet.capture_features
+_captures = threading.local()
+
 model_urls = {
     'resnet18': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
     'resnet34': 'https://download.pytorch.org/models/resnet34-333f7ec4.pth',
@@ -34,6 +40,8 @@ class BasicBlock(nn.Module):
         self.bn2 = nn.BatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
+        # The residual add, as a module so it can be quantized
+        self.skip_add = nn.quantized.FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -48,11 +56,16 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        out = self.skip_add.add_relu(out, residual)
 
         return out
 
+    def fuse_model(self):
+        "Fuse Conv-BN-ReLU and Conv-BN for quantization (eval mode only)"
+        fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+        if self.downsample is not None:
+            fuse_modules(self.downsample, [['0', '1']], inplace=True)
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -137,24 +150,95 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def fuse_model(self):
+        "Fuse Conv-BN(-ReLU) sequences in place, for quantization (eval mode only)"
+        fuse_modules(self, [['conv1', 'bn1', 'relu']], inplace=True)
+        for m in self.modules():
+            if isinstance(m, BasicBlock):
+                m.fuse_model()
+
+    @contextmanager
+    def capture_features(self, layers=('layer4', 'avgpool'), numpy=False):
+        """Capture layer outputs of every forward pass in this thread.
+
+        Yields a list that gets one dict per forward call, mapping each of
+        `layers` (layer1-4, avgpool, fc) to its detached output tensor, or
+        to a numpy array with numpy=True. Captures are per thread and can
+        be nested; forward passes outside a capture record nothing.
+
+            with model.capture_features(['layer4']) as captured:
+                model(images)
+            layer4 = captured[0]['layer4']
+        """
+        stack = getattr(_captures, 'stack', None)
+        if stack is None:
+            stack = _captures.stack = []
+        capture = _Capture(self, layers, numpy)
+        stack.append(capture)
+        try:
+            yield capture.calls
+        finally:
+            stack.remove(capture)
+
+    def _active_captures(self):
+        stack = getattr(_captures, 'stack', None)
+        if not stack:
+            return None
+        active = []
+        for capture in stack:
+            if capture.model is self:
+                outputs = {}
+                capture.calls.append(outputs)
+                active.append((capture, outputs))
+        return active
+
+    @staticmethod
+    def _record(active, name, x):
+        for capture, outputs in active:
+            if name in capture.layers:
+                outputs[name] = x.detach().cpu().numpy() if capture.numpy else x.detach()
+
     def forward(self, x):
+        active = self._active_captures()
+
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
         #x = self.maxpool(x)
 
         x = self.layer1(x)
+        if active:
+            self._record(active, 'layer1', x)
         x = self.layer2(x)
+        if active:
+            self._record(active, 'layer2', x)
         x = self.layer3(x)
+        if active:
+            self._record(active, 'layer3', x)
         x = self.layer4(x)
+        if active:
+            self._record(active, 'layer4', x)
 
         x = self.avgpool(x)
+        if active:
+            self._record(active, 'avgpool', x)
         x = x.view(x.size(0), -1)
         x = self.fc(x)
+        if active:
+            self._record(active, 'fc', x)
 
         return x
 
 
+class _Capture(object):
+
+    def __init__(self, model, layers, numpy):
+        self.model = model
+        self.layers = frozenset(layers)
+        self.numpy = numpy
+        self.calls = []
+
+
 def resnet18(pretrained=False, **kwargs):
     """Constructs a ResNet-18 model.
 
@@ -8,11 +8,14 @@ import torchvision.models as models
 from torchvision import transforms as trn
 from torch.nn import functional as F
 import os
+import sys
 import numpy as np
-from scipy.misc import imresize as imresize
 import cv2
 from PIL import Image
 
+# wideresnet.py with feature capture lives in the notebooks directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'notebooks'))
+
 
 def load_labels():
     # prepare all the labels
@@ -56,22 +59,16 @@ def load_labels():
 
     return classes, labels_IO, labels_attribute, W_attribute
 
-def hook_feature(module, input, output):
-    features_blobs.append(np.squeeze(output.data.cpu().numpy()))
-
 def returnCAM(feature_conv, weight_softmax, class_idx):
     # generate the class activation maps upsample to 256x256
     size_upsample = (256, 256)
     nc, h, w = feature_conv.shape
-    output_cam = []
-    for idx in class_idx:
-        cam = weight_softmax[class_idx].dot(feature_conv.reshape((nc, h*w)))
-        cam = cam.reshape(h, w)
-        cam = cam - np.min(cam)
-        cam_img = cam / np.max(cam)
-        cam_img = np.uint8(255 * cam_img)
-        output_cam.append(imresize(cam_img, size_upsample))
-    return output_cam
+    # one matrix product for all the requested classes
+    cams = np.atleast_2d(weight_softmax[class_idx]).dot(feature_conv.reshape((nc, h*w)))
+    cams = cams - cams.min(axis=1, keepdims=True)
+    cams = cams / np.maximum(cams.max(axis=1, keepdims=True), 1e-12)
+    cam_imgs = np.uint8(255 * cams).reshape(-1, h, w)
+    return [cv2.resize(cam_img, size_upsample) for cam_img in cam_imgs]
 
 def returnTF():
 # load the image transformer
@@ -89,7 +86,6 @@ def load_model():
     model_file = 'wideresnet18_places365.pth.tar'
     if not os.access(model_file, os.W_OK):
         os.system('wget http://places2.csail.mit.edu/models_places365/' + model_file)
-        os.system('wget https://raw.githubusercontent.com/csailvision/places365/master/wideresnet.py')
 
     import wideresnet
     model = wideresnet.resnet18(num_classes=365)
@@ -110,69 +106,70 @@ def load_model():
     #model = torch.load(model_file, map_location=lambda storage, loc: storage, pickle_module=pickle)
 
     model.eval()
-    # hook the feature extractor
-    features_names = ['layer4','avgpool'] # this is the last conv layer of the resnet
-    for name in features_names:
-        model._modules.get(name).register_forward_hook(hook_feature)
+    # layer4 (the last conv layer) and avgpool features come from
+    # model.capture_features(['layer4', 'avgpool'])
     return model
 
 
-# load the labels
-classes, labels_IO, labels_attribute, W_attribute = load_labels()
-
-# load the model
-features_blobs = []
-model = load_model()
-
-# load the transformer
-tf = returnTF() # image transformer
-
-# get the softmax weight
-params = list(model.parameters())
-weight_softmax = params[-2].data.numpy()
-weight_softmax[weight_softmax<0] = 0
-
-# load the test image
-img_url = 'http://places.csail.mit.edu/demo/6.jpg'
-os.system('wget %s -q -O test.jpg' % img_url)
-img = Image.open('test.jpg')
-input_img = V(tf(img).unsqueeze(0))
-
-# forward pass
-logit = model.forward(input_img)
-h_x = F.softmax(logit, 1).data.squeeze()
-probs, idx = h_x.sort(0, True)
-probs = probs.numpy()
-idx = idx.numpy()
-
-print('RESULT ON ' + img_url)
-
-# output the IO prediction
-io_image = np.mean(labels_IO[idx[:10]]) # vote for the indoor or outdoor
-if io_image < 0.5:
-    print('--TYPE OF ENVIRONMENT: indoor')
-else:
-    print('--TYPE OF ENVIRONMENT: outdoor')
-
-# output the prediction of scene category
-print('--SCENE CATEGORIES:')
-for i in range(0, 5):
-    print('{:.3f} -> {}'.format(probs[i], classes[idx[i]]))
-
-# output the scene attributes
-responses_attribute = W_attribute.dot(features_blobs[1])
-idx_a = np.argsort(responses_attribute)
-print('--SCENE ATTRIBUTES:')
-print(', '.join([labels_attribute[idx_a[i]] for i in range(-1,-10,-1)]))
-
-
-# generate class activation mapping
-print('Class activation map is saved as cam.jpg')
-CAMs = returnCAM(features_blobs[0], weight_softmax, [idx[0]])
-
-# render the CAM and output
-img = cv2.imread('test.jpg')
-height, width, _ = img.shape
-heatmap = cv2.applyColorMap(cv2.resize(CAMs[0],(width, height)), cv2.COLORMAP_JET)
-result = heatmap * 0.4 + img * 0.5
-cv2.imwrite('cam.jpg', result)
+if __name__ == '__main__':
+
+    # load the labels
+    classes, labels_IO, labels_attribute, W_attribute = load_labels()
+
+    # load the model
+    model = load_model()
+
+    # load the transformer
+    tf = returnTF() # image transformer
+
+    # get the softmax weight
+    params = list(model.parameters())
+    weight_softmax = params[-2].data.numpy()
+    weight_softmax[weight_softmax<0] = 0
+
+    # load the test image
+    img_url = 'http://places.csail.mit.edu/demo/6.jpg'
+    os.system('wget %s -q -O test.jpg' % img_url)
+    img = Image.open('test.jpg')
+    input_img = V(tf(img).unsqueeze(0))
+
+    # forward pass, keeping the layer4 and avgpool outputs
+    with model.capture_features(['layer4', 'avgpool'], numpy=True) as captured:
+        logit = model.forward(input_img)
+    features_blobs = [np.squeeze(captured[0]['layer4']), np.squeeze(captured[0]['avgpool'])]
+    h_x = F.softmax(logit, 1).data.squeeze()
+    probs, idx = h_x.sort(0, True)
+    probs = probs.numpy()
+    idx = idx.numpy()
+
+    print('RESULT ON ' + img_url)
+
+    # output the IO prediction
+    io_image = np.mean(labels_IO[idx[:10]]) # vote for the indoor or outdoor
+    if io_image < 0.5:
+        print('--TYPE OF ENVIRONMENT: indoor')
+    else:
+        print('--TYPE OF ENVIRONMENT: outdoor')
+
+    # output the prediction of scene category
+    print('--SCENE CATEGORIES:')
+    for i in range(0, 5):
+        print('{:.3f} -> {}'.format(probs[i], classes[idx[i]]))
+
+    # output the scene attributes
+    responses_attribute = W_attribute.dot(features_blobs[1])
+    idx_a = np.argsort(responses_attribute)
+    print('--SCENE ATTRIBUTES:')
+    print(', '.join([labels_attribute[idx_a[i]] for i in range(-1,-10,-1)]))
+
+
+    # generate class activation mapping
+    print('Class activation map is saved as cam.jpg')
+    CAMs = returnCAM(features_blobs[0], weight_softmax, [idx[0]])
+
+    # render the CAM and output
+    img = cv2.imread('test.jpg')
+    height, width, _ = img.shape
+    heatmap = cv2.applyColorMap(cv2.resize(CAMs[0],(width, height)), cv2.COLORMAP_JET)
+    result = heatmap * 0.4 + img * 0.5
+    cv2.imwrite('cam.jpg', result)
@@ -0,0 +1,71 @@
+import random
+import sys
+from timeit import default_timer as timer
+
+import download_osm
+
+"""
+Benchmark download_osm.filter_osm on synthetic OSM extracts of increasing
+size, to check that filtering scales linearly with the number of elements.
+
+    python benchmark_filter_osm.py [max_elements]
+
+Elements are generated on the fly, so memory use is bounded by the filtered
+output rather than by the size of the extract.
+"""
+
+
+def synthetic_elements(n_elements, nodes_per_way=8, seed=0):
+    """
+    Generate n_elements OSM elements shaped like an Overpass response: all
+    nodes first, then ways referencing random runs of those nodes. About 1
+    in 10 elements is a way and about 1 in 5 ways passes the filter.
+    """
+    rng = random.Random(seed)
+    n_ways = n_elements // 10
+    n_nodes = n_elements - n_ways
+    highway_types = ['primary', 'secondary', 'residential', 'service',
+                     'footway', 'track', 'path', 'tertiary', 'unclassified',
+                     'living_street']
+
+    for node_id in range(1, n_nodes + 1):
+        yield {'type': 'node', 'id': node_id,
+               'lat': 45.5 + rng.random(), 'lon': -122.6 + rng.random()}
+
+    for i in range(n_ways):
+        start = rng.randint(1, max(1, n_nodes - nodes_per_way))
+        yield {'type': 'way', 'id': n_nodes + 1 + i,
+               'nodes': list(range(start, start + rng.randint(1, nodes_per_way))),
+               'tags': {'highway': rng.choice(highway_types)}}
+
+
+def time_filter(n_elements):
+    """ Return seconds to generate the extract alone, and to generate and filter it """
+    start = timer()
+    for _ in synthetic_elements(n_elements):
+        pass
+    generate = timer() - start
+
+    start = timer()
+    ways, nodes = download_osm.filter_osm(synthetic_elements(n_elements))
+    total = timer() - start
+    return generate, total, len(ways), len(nodes)
+
+
+def benchmark(sizes):
+
+    print("{:>12} {:>10} {:>10} {:>10} {:>14}".format(
+        'elements', 'ways', 'nodes', 'filter s', 'us / element'))
+
+    for n in sizes:
+        generate, total, n_ways, n_nodes = time_filter(n)
+        filter_time = total - generate
+        print("{:>12,} {:>10,} {:>10,} {:>10.2f} {:>14.3f}".format(
+            n, n_ways, n_nodes, filter_time, 1e6 * filter_time / n))
+
+
+if __name__ == '__main__':
+
+    max_elements = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    sizes = [max_elements // 8, max_elements // 4, max_elements // 2, max_elements]
+    benchmark(sizes)
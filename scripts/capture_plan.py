@@ -0,0 +1,308 @@
+import csv
+import os
+import sys
+import numpy as np
+import geo
+import node_store
+import utils
+
+"""
+Planning stage for Street View downloads, separate from any network I/O.
+
+plan_region() chooses the same capture for every way as
+download_streetview.choose_capture (the middle node, facing the next node
+in the direction of travel), but for a whole region at once with NumPy.
+sample_region() instead places captures every few metres along each way.
+
+Plans are saved as CSV (or Parquet) tables with one row per image, which
+the fetcher reads back in shards so several processes or machines can share
+one region:
+
+    python capture_plan.py portland [both] [spacing in metres]
+"""
+
+PLAN_COLUMNS = ['way_id', 'node_id', 'offset', 'lat', 'lon', 'heading', 'oneway', 'direction']
+PLAN_DTYPES = [np.int64, np.int64, np.int32, np.float64, np.float64, np.float64, np.int8, np.int8]
+
+ONEWAY_VALUES = ('yes', 'true', '1', '-1')
+
+# Metres per degree of latitude, near enough for grid cells
+METRES_PER_DEGREE = 111320.0
+
+
+def _flatten_ways(ways, nodes):
+    """
+    Flatten every way's node list into one array, keeping only the nodes in
+    our nodes dataset. Returns per-way arrays (way_ids, oneway, reverse), the
+    flat node ids and coordinates, and each way's count and start offset
+    into the flat arrays.
+    """
+    if not isinstance(nodes, node_store.NodeStore):
+        nodes = node_store.NodeStore.from_nodes(nodes)
+
+    ways = list(ways.values())
+    n_ways = len(ways)
+    way_ids = np.array([w['id'] for w in ways], dtype=np.int64)
+    tags = [w.get('tags', {}) for w in ways]
+    reverse = np.array([t.get('oneway') == '-1' for t in tags], dtype=bool)
+    oneway = np.array([t.get('oneway') in ONEWAY_VALUES for t in tags], dtype=np.int8)
+
+    lengths = np.array([len(w.get('nodes', [])) for w in ways], dtype=np.int64)
+    flat_ids = np.fromiter((n for w in ways for n in w.get('nodes', [])),
+                           dtype=np.int64, count=int(lengths.sum()))
+    flat_way = np.repeat(np.arange(n_ways), lengths)
+    lats, lons, found = nodes.lookup(flat_ids)
+
+    flat_ids, flat_way, lats, lons = flat_ids[found], flat_way[found], lats[found], lons[found]
+    counts = np.bincount(flat_way, minlength=n_ways)
+    starts = np.cumsum(counts) - counts
+    return way_ids, oneway, reverse, flat_ids, lats, lons, counts, starts
+
+
+def plan_region(ways, nodes, both_directions=False):
+    """
+    Plan one capture per way for a dict of ways (as in ways_<city>.json) and
+    a node_store.NodeStore (or a nodes_<city>.json dict).
+
+    Returns a dict of equal-length arrays: way_id, node_id, offset (always
+    0 here), lat, lon, heading, oneway (1 for one-way streets, 0 otherwise) and direction (0
+    facing along the way, 1 facing back), in the order of ways. Ways with
+    fewer than 2 known nodes are left out. With both_directions, two-way
+    streets get a second capture from the same node facing the other way.
+    """
+    way_ids, oneway, reverse, flat_ids, lats, lons, counts, starts = _flatten_ways(ways, nodes)
+
+    # Middle node, and the node after it in the direction of travel
+    keep = counts >= 2
+    l = counts[keep]
+    middle = (l - 1) // 2
+    middle_idx = starts[keep] + np.where(reverse[keep], l - 1 - middle, middle)
+    next_idx = starts[keep] + np.where(reverse[keep], l - 2 - middle, middle + 1)
+
+    heading, _ = geo.inverse(lats[middle_idx], lons[middle_idx], lats[next_idx], lons[next_idx])
+
+    plan = {'way_id': way_ids[keep],
+            'node_id': flat_ids[middle_idx],
+            'offset': np.zeros(len(middle_idx), dtype=np.int32),
+            'lat': lats[middle_idx],
+            'lon': lons[middle_idx],
+            'heading': heading,
+            'oneway': oneway[keep],
+            'direction': np.zeros(len(middle_idx), dtype=np.int8)}
+
+    if both_directions:
+        plan = add_reverse_captures(plan)
+    return plan
+
+
+def sample_region(ways, nodes, spacing=50.0, both_directions=True, dedupe_radius=10.0):
+    """
+    Plan captures spread along each way rather than just at its middle node.
+
+    Each way's polyline is measured with cumulative geodesic segment
+    lengths and divided into round(length / spacing) equal stretches (at
+    least one), with a capture at the middle of each stretch, facing along
+    the segment it falls on. With both_directions, two-way streets get a
+    second capture facing back from the same point.
+
+    Captures that fall in the same dedupe_radius grid cell with a similar
+    heading (within the same 45 degree bucket) are near-identical panoramas,
+    whether they come from overlapping ways or from a tight bend of one way,
+    and only the first is kept.
+
+    Returns a plan like plan_region's. node_id is the node starting the
+    segment each capture falls on and offset is the distance past that
+    node, in whole metres.
+    """
+    way_ids, oneway, reverse, flat_ids, lats, lons, counts, starts = _flatten_ways(ways, nodes)
+
+    # Put reversed oneway ways in travel order
+    flat_way = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(flat_ids)) - starts[flat_way]
+    flip = reverse[flat_way]
+    order = np.where(flip, starts[flat_way] + counts[flat_way] - 1 - position, np.arange(len(flat_ids)))
+    flat_ids, lats, lons = flat_ids[order], lats[order], lons[order]
+
+    # Segments join consecutive nodes of the same way
+    seg_start = np.flatnonzero(position < counts[flat_way] - 1)
+    seg_way = flat_way[seg_start]
+    seg_heading, seg_length = geo.inverse(lats[seg_start], lons[seg_start],
+                                          lats[seg_start + 1], lons[seg_start + 1])
+    seg_end_distance = np.cumsum(seg_length)
+    seg_start_distance = seg_end_distance - seg_length
+
+    # Length of each way, and where its segments start in the segment arrays
+    seg_counts = np.bincount(seg_way, minlength=len(counts))
+    first_seg = np.cumsum(seg_counts) - seg_counts
+    way_length = np.bincount(seg_way, weights=seg_length, minlength=len(counts))
+
+    keep = seg_counts > 0
+    n_samples = np.where(keep, np.maximum(1, np.round(way_length / spacing)), 0).astype(np.int64)
+    sample_way = np.repeat(np.arange(len(counts)), n_samples)
+    sample_index = np.arange(n_samples.sum()) - (np.cumsum(n_samples) - n_samples)[sample_way]
+    along = (sample_index + 0.5) * way_length[sample_way] / n_samples[sample_way]
+
+    # Find the segment each sample falls on, and interpolate along it
+    way_start_distance = seg_start_distance[first_seg[sample_way]]
+    seg = np.searchsorted(seg_end_distance, way_start_distance + along, side='right')
+    seg = np.clip(seg, first_seg[sample_way], first_seg[sample_way] + seg_counts[sample_way] - 1)
+    past = way_start_distance + along - seg_start_distance[seg]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(seg_length[seg] > 0, past / seg_length[seg], 0.0)
+
+    a, b = seg_start[seg], seg_start[seg] + 1
+    plan = {'way_id': way_ids[sample_way],
+            'node_id': flat_ids[a],
+            'offset': np.round(past).astype(np.int32),
+            'lat': lats[a] + t * (lats[b] - lats[a]),
+            'lon': lons[a] + t * (lons[b] - lons[a]),
+            'heading': seg_heading[seg],
+            'oneway': oneway[sample_way],
+            'direction': np.zeros(len(seg), dtype=np.int8)}
+
+    if both_directions:
+        plan = add_reverse_captures(plan)
+
+    plan = dedupe(plan, dedupe_radius)
+    print("{} ways, {:.1f} km: {} captures".format(
+        int(keep.sum()), way_length.sum() / 1000, len(plan['way_id'])))
+    return plan
+
+
+def dedupe(plan, radius):
+    """
+    Drop captures in the same radius-sized grid cell and 45 degree heading
+    bucket as an earlier capture.
+    """
+    if len(plan['way_id']) == 0:
+        return plan
+
+    cell_lat = np.floor(plan['lat'] * METRES_PER_DEGREE / radius)
+    metres_per_lon = METRES_PER_DEGREE * np.cos(np.radians(plan['lat'].mean()))
+    cell_lon = np.floor(plan['lon'] * metres_per_lon / radius)
+    bucket = np.floor((plan['heading'] % 360) / 45)
+
+    keys = np.stack([cell_lat, cell_lon, bucket], axis=1)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    rows = np.sort(first)
+    return {k: v[rows] for k, v in plan.items()}
+
+
+def add_reverse_captures(plan):
+    """ Add a capture facing the opposite way after each two-way capture """
+    two_way = np.flatnonzero(plan['oneway'] == 0)
+    reverse = {k: v[two_way] for k, v in plan.items()}
+    reverse['heading'] = (reverse['heading'] + 360) % 360 - 180
+    reverse['direction'] = np.ones(len(two_way), dtype=np.int8)
+
+    # Interleave so each reverse capture follows its forward capture
+    order = np.argsort(np.concatenate([np.arange(len(plan['way_id'])), two_way]), kind='stable')
+    return {k: np.concatenate([plan[k], reverse[k]])[order] for k in plan}
+
+
+def capture_filename(way_id, node_id, direction=0, offset=0):
+    """
+    Image filename for a capture: w<way>_n<node>.jpg, with a _d<offset>
+    suffix for captures offset metres past the node, and a _b suffix for
+    captures facing back along the way.
+    """
+    filename = 'w{}_n{}'.format(way_id, node_id)
+    if offset:
+        filename += '_d{}'.format(offset)
+    if direction == 1:
+        filename += '_b'
+    return filename + '.jpg'
+
+
+def write_plan(plan, filename):
+    """ Save a plan as CSV, or as Parquet if filename ends in .parquet """
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    if filename.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame({k: plan[k] for k in PLAN_COLUMNS}).to_parquet(filename, index=False)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(PLAN_COLUMNS)
+            writer.writerows(zip(*[plan[k].tolist() for k in PLAN_COLUMNS]))
+    print(filename, "saved with", len(plan['way_id']), "captures.")
+
+
+def read_plan(filename):
+    """ Load a plan saved by write_plan """
+    if filename.endswith('.parquet'):
+        import pandas as pd
+        df = pd.read_parquet(filename)
+        return {k: df[k].to_numpy().astype(t) for k, t in zip(PLAN_COLUMNS, PLAN_DTYPES)}
+
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = list(zip(*reader)) or [()] * len(header)
+
+    n = len(columns[0])
+    columns = dict(zip(header, columns))
+
+    # Plans saved before offsets were added only have captures at nodes
+    columns.setdefault('offset', [0] * n)
+    return {k: np.array(columns[k], dtype=np.float64 if t is np.float64 else np.int64).astype(t)
+            for k, t in zip(PLAN_COLUMNS, PLAN_DTYPES)}
+
+
+def shard(plan, index, count):
+    """
+    Rows of the plan in shard `index` of `count`. Shards are split by way
+    id, so every capture of a way lands in the same shard.
+    """
+    rows = plan['way_id'] % count == index
+    return {k: v[rows] for k, v in plan.items()}
+
+
+def iter_captures(plan):
+    """ Capture dicts, as consumed by streetview_fetcher, for each row of a plan """
+    columns = [plan[k].tolist() for k in PLAN_COLUMNS]
+    for way_id, node_id, offset, lat, lon, heading, oneway, direction in zip(*columns):
+        yield {'way_id': way_id, 'node_id': node_id, 'offset': offset, 'lat': lat, 'lon': lon,
+               'heading': heading, 'oneway': oneway, 'direction': direction,
+               'filename': capture_filename(way_id, node_id, direction, offset)}
+
+
+def region_plan_filename(region, both_directions=False, spacing=None):
+    return "../data/plans/plan_{}{}{}.csv".format(
+        region,
+        '_both' if both_directions else '',
+        '_every{:g}m'.format(spacing) if spacing else '')
+
+
+def load_region_plan(region, both_directions=False, spacing=None):
+    """
+    The capture plan for a processed region, planned and saved to
+    ../data/plans/ if it's missing or older than the region's ways.
+    Captures are at each way's middle node, or every `spacing` metres along
+    it if spacing is given.
+    """
+    ways_filename = "../data/processed/ways_{}.json".format(region)
+    plan_filename = region_plan_filename(region, both_directions, spacing)
+
+    if (os.path.exists(plan_filename) and
+            os.path.getmtime(plan_filename) >= os.path.getmtime(ways_filename)):
+        return read_plan(plan_filename)
+
+    ways = utils.read_osm(ways_filename)
+    nodes = node_store.load_region(region)
+    if spacing:
+        plan = sample_region(ways, nodes, spacing, both_directions)
+    else:
+        plan = plan_region(ways, nodes, both_directions)
+    write_plan(plan, plan_filename)
+    return plan
+
+
+if __name__ == '__main__':
+
+    numbers = [float(arg) for arg in sys.argv[2:] if arg != 'both']
+    load_region_plan(sys.argv[1], both_directions='both' in sys.argv[2:],
+                     spacing=numbers[0] if numbers else None)
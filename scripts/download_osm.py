@@ -1,6 +1,9 @@
 from OSMPythonTools.nominatim import Nominatim
 from OSMPythonTools.overpass import overpassQueryBuilder, Overpass
+from array import array
 import json
+import numpy as np
+import node_store
 import utils
 
 """
@@ -29,46 +32,110 @@ def download_osm(area_name):
     return elements
 
 
+VALID_HIGHWAY_TYPES = ['primary', 'secondary', 'tertiary', 'motorway']
+
+
+def is_valid_way(ele):
+    """ Exclusion criteria for the ways we will use """
+    return all([ele.get('type') == 'way',
+                ele.get('tags', {}).get('highway') in VALID_HIGHWAY_TYPES,
+                len(ele.get('nodes', [])) >= 2])
+
+
+def in_sorted(sorted_ids, ids):
+    """ Vectorized membership test of ids in a sorted, unique id array """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    idx = np.searchsorted(sorted_ids, ids)
+    idx[idx == len(sorted_ids)] = 0
+    return sorted_ids[idx] == ids
+
+
 def filter_osm(elements):
     """
     Given OSM element data, filter nodes and ways by custom business logic.
     Return filtered OSM data with the nodes and elements we will use.
+
+    Makes a single pass over elements, so it also accepts a generator such as
+    utils.iter_osm. Node ids and coordinates are collected into compact int64 /
+    float64 buffers and joined against the referenced node ids at the end.
     """
     filtered_ways = {}
 
-    filtered_node_ids = set()
-    filtered_nodes = {}
+    way_node_ids = array('q')
+    node_ids = array('q')
+    node_lats = array('d')
+    node_lons = array('d')
 
     for ele in elements:
 
-        tags = ele.get('tags', {})
-
-        ele_id = ele.get('id')
-        element_type = ele.get('type')
-        highway_type = tags.get('highway')
-        nodes = ele.get('nodes', [])
-        highway_length = len(nodes)
-
-        valid_highway_types = ['primary', 'secondary', 'tertiary', 'motorway']
+        if ele.get('type') == 'node':
+            node_ids.append(ele['id'])
+            node_lats.append(ele.get('lat', np.nan))
+            node_lons.append(ele.get('lon', np.nan))
 
         # Apply exclusion criteria
-        if all([element_type == 'way',
-                highway_type in valid_highway_types,
-                highway_length >= 2]):
+        elif is_valid_way(ele):
+            way_node_ids.extend(ele['nodes'])
+            filtered_ways[ele.get('id')] = ele
 
-            filtered_node_ids = filtered_node_ids.union(set(nodes))
-            filtered_ways[ele_id] = ele
+    # Join referenced node ids against all node coordinates in one go
+    wanted = np.unique(np.frombuffer(way_node_ids, dtype=np.int64))
+    node_ids = np.frombuffer(node_ids, dtype=np.int64)
+    keep = in_sorted(wanted, node_ids)
 
-    for ele in elements:
-
-        if ele.get('type') == 'node':
-            node_id = ele.get('id')
-            if node_id in filtered_node_ids:
-                filtered_nodes[node_id] = (ele.get('lat'), ele.get('lon'))
+    filtered_nodes = dict(zip(node_ids[keep].tolist(),
+                              zip(np.frombuffer(node_lats)[keep].tolist(),
+                                  np.frombuffer(node_lons)[keep].tolist())))
 
     return filtered_ways, filtered_nodes
 
 
+def filter_osm_file(raw_filename, ways_filename, nodes_filename, chunk_size=100000):
+    """
+    Streaming version of filter_osm. Reads raw OSM elements from disk (JSON
+    written by write_osm, or an .osm.pbf extract) one at a time and writes
+    the filtered ways and nodes as they are found, so only the ids of the
+    nodes we need are held in memory.
+
+    Makes two passes over raw_filename, since a node may appear before the
+    way that references it. Nodes are matched against the referenced ids in
+    chunks of chunk_size. Returns the number of ways and nodes written.
+    """
+    way_node_ids = array('q')
+
+    def ways():
+        for ele in utils.iter_osm(raw_filename):
+            if is_valid_way(ele):
+                way_node_ids.extend(ele['nodes'])
+                yield ele['id'], ele
+
+    def nodes():
+        wanted = np.unique(np.frombuffer(way_node_ids, dtype=np.int64))
+        chunk = []
+        for ele in utils.iter_osm(raw_filename):
+            if ele.get('type') == 'node':
+                chunk.append((ele['id'], ele.get('lat', np.nan), ele.get('lon', np.nan)))
+                if len(chunk) == chunk_size:
+                    yield from _matching_nodes(wanted, chunk)
+                    chunk = []
+        yield from _matching_nodes(wanted, chunk)
+
+    n_ways = utils.write_osm_items(ways(), ways_filename)
+    n_nodes = utils.write_osm_items(nodes(), nodes_filename)
+    return n_ways, n_nodes
+
+
+def _matching_nodes(wanted, chunk):
+    """ Yield (id, (lat, lon)) for the nodes in chunk whose ids are in wanted """
+    if not chunk:
+        return
+    ids = np.array([c[0] for c in chunk], dtype=np.int64)
+    for i in np.flatnonzero(in_sorted(wanted, ids)).tolist():
+        node_id, lat, lon = chunk[i]
+        yield node_id, (lat, lon)
+
+
 def download_and_filter_all_regions(regions):
 
     for region in regions:
@@ -78,21 +145,22 @@ def download_and_filter_all_regions(regions):
         raw_data_filename = "../data/raw/raw_osm_{}.json".format(city_name)
         ways_filename = "../data/processed/ways_{}.json".format(city_name)
         nodes_filename = "../data/processed/nodes_{}.json".format(city_name)
+        node_store_dirname = "../data/processed/nodes_{}".format(city_name)
 
         # Download
         elements = download_osm(region)
 
-        # Save raw data
+        # Save raw data, then let go of it before filtering
         utils.write_osm(elements, raw_data_filename)
+        del elements
 
-        # Filter
-        ways, nodes = filter_osm(elements)
-        print(len(ways), "ways in filtered data")
-        print(len(nodes), "nodes in filtered data")
+        # Filter from disk and save processed data
+        n_ways, n_nodes = filter_osm_file(raw_data_filename, ways_filename, nodes_filename)
+        print(n_ways, "ways in filtered data")
+        print(n_nodes, "nodes in filtered data")
 
-        # Save processed data
-        utils.write_osm(ways, ways_filename)
-        utils.write_osm(nodes, nodes_filename)
+        # Columnar copy of the nodes for fast lookups
+        node_store.convert(nodes_filename, node_store_dirname)
 
 
 def download_portland():
@@ -106,14 +174,11 @@ def download_portland():
     # utils.write_osm(portland, raw_data_filename)
     # print("Data written to ", raw_data_filename)
 
-    portland = utils.read_osm(raw_data_filename)
-    ways, nodes = filter_osm(portland)
-    print(len(portland), "elements in all of portland data")
-    print(len(ways), "ways in all of filtered_portland data")
-    print(len(nodes), "nodes in all of filtered_portland data")
-
-    utils.write_osm(ways, filtered_ways_filename)
-    utils.write_osm(nodes, filtered_nodes_filename)
+    n_ways, n_nodes = filter_osm_file(raw_data_filename,
+                                      filtered_ways_filename,
+                                      filtered_nodes_filename)
+    print(n_ways, "ways in all of filtered_portland data")
+    print(n_nodes, "nodes in all of filtered_portland data")
 
 if __name__ == '__main__':
 
@@ -4,30 +4,22 @@ from urllib.parse import urlencode
 import requests
 import os
 import json
+import capture_plan
+from image_store import ImageStore
+from manifest import Manifest, DONE_STATUSES
+from metadata_cache import MetadataCache
+import node_store
+import streetview_fetcher
 import utils
 from pprint import pprint
 import shutil
 
 
-def download_street(way, nodes, cautious=True, download=True):
+def choose_capture(way, nodes):
     """
-    Download StreetView images for an entire street.
-
-        Strategy:
-
-    Take a StreetView image from the middle node of a way.
-
-    Check if the node is available in Street View. To do this, check that the
-    Street View location is within X meters of the node location.
-
-        If not, try the next node.
-
-    Once a suitable node has been found,
-
-        If the street is two-way, take it in both directions
-        If one-way, take it in the direction of the road.
-
-    Save the image as <way_id>_<node_id>.jpg in the data/images/ directory.
+    Choose where to photograph a way from: its middle node, facing the next
+    node along the direction of travel. Returns a capture dict, or None if
+    too few of the way's nodes are in our nodes dataset.
     """
 
     way_id = way['id']
@@ -42,7 +34,7 @@ def download_street(way, nodes, cautious=True, download=True):
     # If there are less than 3 nodes in our ndoes dataset, exclude this road
     if len(potential_nodes) < 2:
         print("Not enough nodes found for way:", way_id)
-        return
+        return None
 
     # Flip reversed oneway streets: consider last node as first (uncommon)
     if way.get('tags', {}).get('oneway') == '-1':
@@ -57,30 +49,62 @@ def download_street(way, nodes, cautious=True, download=True):
         middle_idx = len(potential_nodes) // 2
 
     middle_node_id, next_node_id = potential_nodes[middle_idx], potential_nodes[middle_idx + 1]
-    # print(middle_node_id, next_node_id)
 
     middle_node = nodes.get(str(middle_node_id))
     next_node = nodes.get(str(next_node_id))
-    # pprint(middle_node)
-    # pprint(next_node)
 
     heading = Geodesic.WGS84.Inverse(*middle_node, *next_node)['azi1']
-    location = "{},{}".format(*middle_node)
-    query_params = {
-        'size': '640x640',
-        'location': location,
-        'heading': heading,
-        'pitch': '0',
-        'key': os.environ['GOOGLE_MAPS_API_KEY'],
-        'radius': 10
-    }
+
+    return {'way_id': way_id,
+            'node_id': middle_node_id,
+            'lat': middle_node[0],
+            'lon': middle_node[1],
+            'heading': heading,
+            'filename': 'w{}_n{}.jpg'.format(way_id, middle_node_id)}
+
+
+def download_street(way, nodes, cautious=True, download=True, cache=None):
+    """
+    Download StreetView images for an entire street.
+
+        Strategy:
+
+    Take a StreetView image from the middle node of a way.
+
+    Check if the node is available in Street View. To do this, check that the
+    Street View location is within X meters of the node location.
+
+        If not, try the next node.
+
+    Once a suitable node has been found,
+
+        If the street is two-way, take it in both directions
+        If one-way, take it in the direction of the road.
+
+    Save the image as <way_id>_<node_id>.jpg in the data/images/ directory.
+
+    Metadata is looked up in cache (a metadata_cache.MetadataCache) first,
+    if one is given.
+    """
+
+    capture = choose_capture(way, nodes)
+    if capture is None:
+        return
+
+    way_id = way['id']
+    middle_node = (capture['lat'], capture['lon'])
+    query_params = streetview_fetcher.query_params(capture)
 
     # Fist, do a meta-data query to see if the image is available.
-    metadata_url = 'https://maps.googleapis.com/maps/api/streetview/metadata'
-    metadata_link = metadata_url + '?' + urlencode(query_params)
-    metadata = requests.get(metadata_link, stream=True).json()
-    # print(metadata_link)
-    # pprint(metadata)
+    metadata = cache.get(capture['lat'], capture['lon'], query_params['radius']) if cache else None
+    if metadata is None:
+        metadata_url = streetview_fetcher.BASE_URL + '/streetview/metadata'
+        metadata_link = metadata_url + '?' + urlencode(query_params)
+        metadata = requests.get(metadata_link, stream=True).json()
+        # print(metadata_link)
+        # pprint(metadata)
+        if cache:
+            cache.put(capture['lat'], capture['lon'], query_params['radius'], metadata)
 
     if metadata['status'] != 'OK':
         print("No image found.")
@@ -96,10 +120,9 @@ def download_street(way, nodes, cautious=True, download=True):
     # print(osm_sv_diff)
     print(way_id, ' distance:', osm_sv_diff['s12'])
 
-    image_url = 'https://maps.googleapis.com/maps/api/streetview'
+    image_url = streetview_fetcher.BASE_URL + '/streetview'
     image_link = image_url + '?' + urlencode(query_params)
-    image_filepath = os.path.join('../data/images/',
-                                  'w{}_n{}.jpg'.format(way_id, middle_node_id))
+    image_filepath = os.path.join('../data/images/', capture['filename'])
 
     if cautious:
         print("************** CAUTION *******************")
@@ -124,7 +147,7 @@ def test_street(way_id, ways, nodes):
 def test_portland():
 
     ways = utils.read_osm("../data/processed/ways_portland.json")
-    nodes = utils.read_osm("../data/processed/nodes_portland.json")
+    nodes = node_store.load_region("portland")
 
     # Good street
     # test_street("5542164", ways, nodes)
@@ -142,7 +165,7 @@ def test_portland():
 def test_boulder():
 
     ways = utils.read_osm("../data/processed/ways_boulder.json")
-    nodes = utils.read_osm("../data/processed/nodes_boulder.json")
+    nodes = node_store.load_region("boulder")
 
     # Good street
     # download_street(ways['382375782'], nodes)
@@ -158,7 +181,7 @@ def test_boulder():
 def test_small():
 
     ways = utils.read_osm("../data/processed/ways_portland.json")
-    nodes = utils.read_osm("../data/processed/nodes_portland.json")
+    nodes = node_store.load_region("portland")
 
     print(len(ways))
 
@@ -170,19 +193,21 @@ def test_small():
 def test_large_no_download():
 
     ways = utils.read_osm("../data/processed/ways_portland.json")
-    nodes = utils.read_osm("../data/processed/nodes_portland.json")
+    nodes = node_store.load_region("portland")
 
     print(len(ways))
 
     import random
+    cache = MetadataCache()
     for _ in range(100):
         way_id = random.choice(list(ways.keys()))
-        download_street(ways[str(way_id)], nodes, cautious=False, download=False)
+        download_street(ways[str(way_id)], nodes, cautious=False, download=False, cache=cache)
+    cache.close()
 
 # def test_large_download():
 #     """ NOTE: Each image costs 0.7 cents to download; be careful """
 #     ways = utils.read_osm("../data/processed/ways_portland.json")
-#     nodes = utils.read_osm("../data/processed/nodes_portland.json")
+#     nodes = node_store.load_region("portland")
 #
 #     print(len(ways))
 #
@@ -193,22 +218,17 @@ def test_large_no_download():
 
 
 def test_complete_no_download():
+    """ Check metadata for every region; repeat runs are served from the metadata cache """
 
     for region in ["boulder", "pittsburgh", "seattle", "portland"]:
-
-        ways = utils.read_osm("../data/processed/ways_{}.json".format(region))
-        nodes = utils.read_osm("../data/processed/nodes_{}.json".format(region))
-
-        print(region, " - {} ways".format(len(ways)))
-
-        for way_id in ways.keys():
-            download_street(ways[way_id], nodes, cautious=False, download=False)
+        print(region)
+        download_region(region, download=False)
 
 
 def download_boulder():
 
     ways = utils.read_osm("../data/processed/ways_boulder.json")
-    nodes = utils.read_osm("../data/processed/nodes_boulder.json")
+    nodes = node_store.load_region("boulder")
 
     print(len(ways), "ways")
 
@@ -216,24 +236,94 @@ def download_boulder():
         download_street(ways[way_id], nodes, cautious=False, download=True)
 
 
-def download_region(region):
+def download_region(region, workers=8, qps=20, download=True, only_failures=False,
+                    both_directions=False, spacing=None, shard_index=0, shard_count=1,
+                    use_store=False):
+    """
+    Download StreetView images for every capture in a region's capture
+    plan (see capture_plan.py), fetching up to `workers` captures at once at
+    no more than `qps` requests per second.
 
-    ways = utils.read_osm("../data/processed/ways_{}.json".format(region))
-    nodes = utils.read_osm("../data/processed/nodes_{}.json".format(region))
+    Every result is saved to the region's manifest, so an interrupted
+    download resumes where it stopped: captures already downloaded or known
+    to have no image are skipped, and failed captures are tried again. Set
+    only_failures to retry just the captures that failed last time.
 
-    print(len(ways), "ways")
+    By default each way is captured once at its middle node; give spacing
+    (in metres) to capture it at points all along its length instead.
 
-    for way_id in ways.keys():
-        download_street(ways[way_id], nodes, cautious=False, download=True)
+    To split a region across processes or machines, give each one a
+    different shard_index out of the same shard_count.
 
+    With use_store, images go into the content-addressed image store
+    (image_store.py) instead of ../data/images/.
+    """
 
-def download_rest_of_portland():
+    plan = capture_plan.load_region_plan(region, both_directions, spacing)
+    plan = capture_plan.shard(plan, shard_index, shard_count)
+    manifest = Manifest("../data/manifests/streetview_{}.sqlite".format(region))
+    cache = MetadataCache()
+    store = ImageStore() if use_store else None
 
-    ways = utils.read_osm("../data/processed/ways_portland.json")
-    nodes = utils.read_osm("../data/processed/nodes_portland.json")
+    print(len(plan['way_id']), "captures in shard {} of {}".format(shard_index, shard_count))
+    print("Manifest:", manifest.counts())
 
-    for way_id in list(ways.keys())[6719:]:
-        download_street(ways[way_id], nodes, cautious=False, download=True)
+    if only_failures:
+        failed = manifest.filenames(['error'])
+        captures = (c for c in capture_plan.iter_captures(plan) if c['filename'] in failed)
+    else:
+        # Dry runs don't need to re-check metadata that's already known
+        skip = manifest.filenames(DONE_STATUSES if download else DONE_STATUSES + ('available',))
+        captures = (c for c in capture_plan.iter_captures(plan) if c['filename'] not in skip)
+
+    for result in streetview_fetcher.fetch_captures(captures, workers=workers, qps=qps,
+                                                    download=download, cache=cache,
+                                                    store=store):
+        manifest.record(result)
+        print(result['way_id'], result['status'], 'distance:', result['distance'])
+
+    print("Manifest:", manifest.counts())
+    manifest.close()
+    cache.close()
+    if store is not None:
+        store.close()
+
+
+def _download_shard(args):
+    region, kwargs = args
+    download_region(region, **kwargs)
+
+
+def download_region_parallel(region, processes=4, qps=20, **kwargs):
+    """
+    Download a region with one process per shard of its capture plan,
+    sharing a total budget of `qps` requests per second.
+    """
+    from multiprocessing import Pool
+
+    # Plan once up front, rather than in every process
+    capture_plan.load_region_plan(region, kwargs.get('both_directions', False),
+                                  kwargs.get('spacing'))
+
+    jobs = [(region, dict(kwargs, qps=qps / processes, shard_index=i, shard_count=processes))
+            for i in range(processes)]
+    with Pool(processes) as pool:
+        pool.map(_download_shard, jobs)
+
+
+def download_rest_of_portland():
+    """
+    Resume the Portland download from its manifest. The first Portland images
+    were downloaded before manifests existed, so a new manifest must first be
+    seeded with the images already in ../data/images/, or they would all be
+    fetched (and paid for) again.
+    """
+    manifest = Manifest("../data/manifests/streetview_portland.sqlite")
+    if not manifest.counts() and os.path.isdir('../data/images/'):
+        manifest.record_existing_images('../data/images/')
+    manifest.close()
+
+    download_region("portland")
 
 
 if __name__ == '__main__':
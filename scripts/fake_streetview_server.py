@@ -0,0 +1,79 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import random
+import threading
+
+"""
+Local stand-in for the Street View Static API, for testing downloaders
+without spending API credits. Serves /maps/api/streetview/metadata and
+/maps/api/streetview with the same parameters as the real endpoints.
+
+Every tenth location has no imagery. A fraction of requests (fail_rate)
+fail with HTTP 503 to exercise retries.
+"""
+
+# Smallest useful stand-in for a JPEG: SOI marker, padding, EOI marker
+FAKE_JPEG = b'\xff\xd8' + b'\x00' * 1024 + b'\xff\xd9'
+
+
+class StreetViewHandler(BaseHTTPRequestHandler):
+
+    fail_rate = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if random.random() < self.fail_rate:
+            self.send_error(503)
+            return
+
+        if 'location' not in params or 'key' not in params:
+            self.send_error(400)
+            return
+
+        lat, lon = [float(x) for x in params['location'][0].split(',')]
+        # Deterministic gaps in coverage
+        has_image = int(round(lat * 1e4)) % 10 != 0
+
+        if url.path == '/maps/api/streetview/metadata':
+            if has_image:
+                # Snap the panorama a few metres away from the request
+                metadata = {'status': 'OK', 'pano_id': 'fake',
+                            'location': {'lat': lat + 2e-5, 'lng': lon + 2e-5}}
+            else:
+                metadata = {'status': 'ZERO_RESULTS'}
+            self._send(200, 'application/json', json.dumps(metadata).encode())
+
+        elif url.path == '/maps/api/streetview':
+            self._send(200, 'image/jpeg', FAKE_JPEG)
+
+        else:
+            self.send_error(404)
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(host='127.0.0.1', port=0, fail_rate=0.0):
+    """ Start the server in a background thread. Call .shutdown() to stop it """
+    handler = type('Handler', (StreetViewHandler,), {'fail_rate': fail_rate})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    server = ThreadingHTTPServer(('127.0.0.1', 8765), StreetViewHandler)
+    print("Serving fake Street View on http://127.0.0.1:8765/maps/api")
+    server.serve_forever()
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+
+"""
+Content-addressed store for Street View images. Each unique JPEG is kept
+once, at objects/<first 2 hex digits>/<sha256>.jpg, and an index maps
+capture filenames (w<way>_n<node>.jpg) to their content hash. Panoramas
+returned for more than one way are detected and stored once, and dataset
+splits are hardlinks into the store rather than copies.
+
+    python image_store.py ../data/images/ [--remove]   # add loose images to the store
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    sha256 TEXT,
+    size INTEGER
+)
+"""
+
+
+class ImageStore(object):
+
+    def __init__(self, root='../data/store'):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, 'index.sqlite'),
+                                    check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)")
+        self.conn.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.jpg')
+
+    def put(self, filename, data):
+        """
+        Store image bytes under a capture filename. Returns the object path,
+        and whether identical bytes were already stored for another filename.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so a crash never leaves a truncated object
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        return path, self._index(filename, digest, len(data))
+
+    def put_file(self, filename, from_path):
+        """
+        Store an image file already on disk, hardlinking it as its object when
+        the content is new, so no second copy is written. Returns like put().
+        """
+        with open(from_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        path = self.object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp{}'.format(os.getpid())
+            link_or_copy(from_path, tmp_path)
+            os.replace(tmp_path, path)
+
+        return path, self._index(filename, digest, os.path.getsize(path))
+
+    def _index(self, filename, digest, size):
+        """ Record filename -> digest; True if another filename has the same content """
+        with self.lock:
+            duplicate = self.conn.execute(
+                "SELECT 1 FROM images WHERE sha256=? AND filename!=? LIMIT 1",
+                (digest, filename)).fetchone() is not None
+            self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                              (filename, digest, size))
+            self.conn.commit()
+        return duplicate
+
+    def path(self, filename):
+        """ Object path of a capture filename, or None if it isn't stored """
+        with self.lock:
+            row = self.conn.execute("SELECT sha256 FROM images WHERE filename=?",
+                                    (filename,)).fetchone()
+        return self.object_path(row[0]) if row else None
+
+    def filenames(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT filename FROM images")]
+
+    def duplicates(self):
+        """ Lists of capture filenames that share identical image content """
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT sha256, filename FROM images WHERE sha256 IN (
+                    SELECT sha256 FROM images GROUP BY sha256 HAVING COUNT(*) > 1)
+                ORDER BY sha256
+                """).fetchall()
+        groups = {}
+        for digest, filename in rows:
+            groups.setdefault(digest, []).append(filename)
+        return list(groups.values())
+
+    def ingest_directory(self, image_dir, remove=False):
+        """
+        Add loose w<way>_n<node>.jpg images to the store. New content is
+        hardlinked into the store rather than copied; with remove, the loose
+        names are deleted afterwards. Returns the number of images and of
+        duplicates.
+        """
+        n = duplicates = 0
+        for entry in os.scandir(image_dir):
+            if not (entry.is_file() and entry.name.endswith('.jpg')):
+                continue
+            _, duplicate = self.put_file(entry.name, entry.path)
+            duplicates += duplicate
+            n += 1
+            if remove:
+                os.remove(entry.path)
+            if n % 1000 == 0:
+                print(n, "images stored")
+        print(n, "images stored,", duplicates, "duplicates")
+        return n, duplicates
+
+    def export(self, filename, to_path):
+        """ Hardlink a stored image to to_path, copying only if linking fails """
+        link_or_copy(self.path(filename), to_path)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def link_or_copy(from_path, to_path):
+    """ Hardlink from_path to to_path, falling back to a copy across filesystems """
+    os.makedirs(os.path.dirname(to_path), exist_ok=True)
+    if os.path.exists(to_path):
+        os.remove(to_path)
+    try:
+        os.link(from_path, to_path)
+    except OSError:
+        shutil.copyfile(from_path, to_path)
+
+
+if __name__ == '__main__':
+
+    args = [a for a in sys.argv[1:] if a != '--remove']
+    store = ImageStore()
+    store.ingest_directory(args[0] if args else '../data/images/', remove='--remove' in sys.argv)
+    for group in store.duplicates():
+        print("Same panorama:", ', '.join(group))
+    store.close()
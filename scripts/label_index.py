@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import utils
+
+"""
+Way id -> (region, label, tags) index for labeling images, built once from
+the processed ways of every region and saved as a memory-mappable .npy
+table sorted by way id. Labeling a directory of images is then a batched
+binary-search join on the way ids parsed from the filenames.
+"""
+
+REGIONS = ["boulder", "pittsburgh", "seattle", "portland"]
+
+LABEL_TAGS = ['highway', 'bicycle', 'cycleway', 'lanes', 'maxspeed', 'oneway']
+
+BIKE_CYCLEWAYS = ['lane', 'shared', 'shared_lane', 'opposite_lane', 'yes',
+                  'cycle_greenway', 'track', 'share_busway']
+
+# Tag values are stored as fixed-width utf-8; longer values are truncated
+TAG_WIDTH = 32
+
+INDEX_DTYPE = np.dtype([('way_id', np.int64), ('region', np.int8), ('label', np.int8)] +
+                       [(tag, 'S{}'.format(TAG_WIDTH)) for tag in LABEL_TAGS])
+
+INDEX_FILENAME = "../data/processed/label_index.npy"
+
+
+def bike_label(tags):
+    """ 1 if a way's tags mark it as bike-designated, otherwise 0 """
+    bicycle = tags.get('bicycle', '').strip()
+    cycleway = tags.get('cycleway', '').strip()
+    if bicycle == 'designated' or 'yes' in bicycle or cycleway in BIKE_CYCLEWAYS:
+        return 1
+    return 0
+
+
+def build_label_index(regions=REGIONS, filename=INDEX_FILENAME):
+    """
+    Build the label index from ../data/processed/ways_<region>.json for each
+    region. If a way appears in more than one region, the first region wins.
+    """
+    rows = []
+    for region_code, region in enumerate(regions):
+        ways = utils.read_osm("../data/processed/ways_{}.json".format(region))
+        for way in ways.values():
+            tags = way.get('tags', {})
+            rows.append((way['id'], region_code, bike_label(tags)) +
+                        tuple(tags.get(tag, '').strip().encode('utf-8')[:TAG_WIDTH]
+                              for tag in LABEL_TAGS))
+
+    index = np.array(rows, dtype=INDEX_DTYPE)
+    index = index[np.argsort(index['way_id'], kind='stable')]
+    first = np.ones(len(index), dtype=bool)
+    first[1:] = index['way_id'][1:] != index['way_id'][:-1]
+    index = index[first]
+
+    np.save(filename, index)
+    with open(regions_filename(filename), 'w') as f:
+        f.write('\n'.join(regions))
+    print(filename, "saved with", len(index), "ways.")
+    return index
+
+
+def regions_filename(filename):
+    """ Regions an index was built for, in region code order """
+    return os.path.splitext(filename)[0] + '_regions.txt'
+
+
+def _built_regions(filename):
+    try:
+        with open(regions_filename(filename)) as f:
+            return f.read().split('\n')
+    except FileNotFoundError:
+        return None
+
+
+def load_label_index(regions=REGIONS, filename=INDEX_FILENAME):
+    """
+    Memory-map the label index, rebuilding it if it was built for other
+    regions or any region's ways are newer
+    """
+    regions = list(regions)
+    ways_filenames = ["../data/processed/ways_{}.json".format(r) for r in regions]
+    if (not os.path.exists(filename) or _built_regions(filename) != regions or
+            os.path.getmtime(filename) < max(os.path.getmtime(f) for f in ways_filenames)):
+        build_label_index(regions, filename)
+    return np.load(filename, mmap_mode='r')
+
+
+def lookup(index, way_ids):
+    """ Index rows for an array of way ids, and a mask of which were found """
+    way_ids = np.asarray(way_ids, dtype=np.int64)
+    if len(index) == 0:
+        return index[:0], np.zeros(len(way_ids), dtype=bool)
+    i = np.minimum(np.searchsorted(index['way_id'], way_ids), len(index) - 1)
+    return index[i], index['way_id'][i] == way_ids
+
+
+def image_way_id(path):
+    """
+    Way id of an image named w<way>_n<node>...jpg, or -1. notebooks/runtime.py
+    has to stay free of this repo's scripts, so it keeps an identical copy;
+    change both together.
+    """
+    try:
+        return int(os.path.basename(path).split('_')[0][1:])
+    except ValueError:
+        return -1
+
+
+def iter_image_labels(filenames, index, regions=REGIONS, batch_size=10000):
+    """
+    Label rows for an iterable of image filenames, joined against the label
+    index a batch at a time.
+    """
+    batch = []
+    for filename in filenames:
+        batch.append(filename)
+        if len(batch) == batch_size:
+            yield from _label_batch(batch, index, regions)
+            batch = []
+    yield from _label_batch(batch, index, regions)
+
+
+def _label_batch(filenames, index, regions):
+    if not filenames:
+        return
+    rows, found = lookup(index, [image_way_id(f) for f in filenames])
+    if len(rows) == 0:
+        rows = [None] * len(filenames)
+    for filename, row, ok in zip(filenames, rows, found):
+        label_row = {'filename': filename, 'region': regions[row['region']] if ok else ''}
+        for tag in LABEL_TAGS:
+            label_row[tag] = row[tag].decode('utf-8', errors='ignore') if ok else ''
+        label_row['label'] = int(row['label']) if ok else 0
+        yield label_row
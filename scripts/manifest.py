@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import time
+
+"""
+Persistent record of Street View downloads, one row per capture (keyed by
+image filename), so interrupted downloads resume where they stopped and
+re-runs skip work that has already been paid for.
+
+Statuses:
+    ok         image saved
+    no_image   metadata says there is no panorama here
+    available  metadata OK, image not downloaded (dry run)
+    error      HTTP or connection error; retried on the next run
+"""
+
+# Statuses that never need fetching again
+DONE_STATUSES = ('ok', 'no_image')
+
+# Columns added since the first version of the schema
+ADDED_COLUMNS = [('pano_lat', 'REAL'), ('pano_lon', 'REAL'), ('matched_way_id', 'INTEGER')]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    filename TEXT PRIMARY KEY,
+    way_id INTEGER,
+    node_id INTEGER,
+    heading REAL,
+    status TEXT,
+    distance REAL,
+    pano_lat REAL,
+    pano_lon REAL,
+    matched_way_id INTEGER,
+    http_status INTEGER,
+    filepath TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 1,
+    updated REAL
+)
+"""
+
+
+class Manifest(object):
+
+    def __init__(self, filename):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # Shards of one region may share the manifest from separate processes
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(captures)")}
+        for column, column_type in ADDED_COLUMNS:
+            if column not in existing:
+                self.conn.execute("ALTER TABLE captures ADD COLUMN {} {}".format(column, column_type))
+        self.conn.commit()
+
+    def record(self, result):
+        """ Save the result dict of a capture returned by streetview_fetcher """
+        self.conn.execute(
+            """
+            INSERT INTO captures (filename, way_id, node_id, heading, status, distance,
+                                  pano_lat, pano_lon, http_status, filepath, error, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                status=excluded.status, distance=excluded.distance,
+                pano_lat=COALESCE(excluded.pano_lat, pano_lat),
+                pano_lon=COALESCE(excluded.pano_lon, pano_lon),
+                http_status=excluded.http_status, filepath=excluded.filepath,
+                error=excluded.error, updated=excluded.updated,
+                attempts=attempts + 1
+            """,
+            (result['filename'], result['way_id'], result['node_id'], result['heading'],
+             result['status'], result['distance'], result.get('pano_lat'), result.get('pano_lon'),
+             result['http_status'], result['filepath'], result.get('error'), time.time()))
+        self.conn.commit()
+
+    def set_matched_ways(self, matches):
+        """ Save (filename, matched_way_id) pairs found by spatial_index.match_panoramas """
+        self.conn.executemany("UPDATE captures SET matched_way_id=? WHERE filename=?",
+                              [(way_id, filename) for filename, way_id in matches])
+        self.conn.commit()
+
+    def filenames(self, statuses):
+        """ Set of capture filenames with any of the given statuses """
+        query = "SELECT filename FROM captures WHERE status IN ({})".format(
+            ','.join('?' * len(statuses)))
+        return {row[0] for row in self.conn.execute(query, tuple(statuses))}
+
+    def counts(self):
+        """ Number of captures per status """
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM captures GROUP BY status"))
+
+    def record_existing_images(self, image_dir='../data/images/'):
+        """
+        Mark images already on disk as downloaded. Only needed once, for images
+        fetched before the manifest existed.
+        """
+        n = 0
+        for filename in os.listdir(image_dir):
+            if not (filename.startswith('w') and filename.endswith('.jpg')):
+                continue
+            way_id, node_id = filename[:-len('.jpg')].split('_')[:2]
+            self.conn.execute(
+                """
+                INSERT OR IGNORE INTO captures (filename, way_id, node_id, status, filepath, updated)
+                VALUES (?, ?, ?, 'ok', ?, ?)
+                """,
+                (filename, int(way_id[1:]), int(node_id[1:]),
+                 os.path.join(image_dir, filename), time.time()))
+            n += 1
+        self.conn.commit()
+        print(n, "existing images recorded.")
+
+    def close(self):
+        self.conn.close()
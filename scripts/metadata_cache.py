@@ -0,0 +1,105 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""
+On-disk cache of Street View metadata responses, consulted before any
+metadata request so that re-runs and dry runs don't hit the network.
+
+Responses are keyed by location rounded to `precision` decimal places
+(6 places is about 10 cm) and search radius. Heading is not part of the
+key: the metadata response does not depend on it, so captures facing both
+ways from the same point share one entry. Entries expire after ttl seconds,
+and the least recently used entries are evicted beyond max_entries.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    lat REAL,
+    lon REAL,
+    radius INTEGER,
+    response TEXT,
+    created REAL,
+    used REAL,
+    PRIMARY KEY (lat, lon, radius)
+)
+"""
+
+# Only definite answers are cached; errors and quota problems are retried
+CACHEABLE_STATUSES = ('OK', 'ZERO_RESULTS', 'NOT_FOUND')
+
+
+class MetadataCache(object):
+
+    def __init__(self, filename='../data/cache/streetview_metadata.sqlite',
+                 ttl=30 * 24 * 3600, max_entries=1000000, precision=6):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        # Shared by the fetcher's worker threads, and by shard processes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)")
+        self.conn.commit()
+
+    def _key(self, lat, lon, radius):
+        return round(float(lat), self.precision), round(float(lon), self.precision), int(radius)
+
+    def get(self, lat, lon, radius):
+        """ Cached metadata response for a location, or None """
+        key = self._key(lat, lon, radius)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, created FROM metadata WHERE lat=? AND lon=? AND radius=?",
+                key).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE metadata SET used=? WHERE lat=? AND lon=? AND radius=?",
+                              (now,) + key)
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, lat, lon, radius, metadata):
+        """ Cache a metadata response, if it's a definite answer """
+        if metadata.get('status') not in CACHEABLE_STATUSES:
+            return
+        key = self._key(lat, lon, radius)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                              key + (json.dumps(metadata), now, now))
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """ Drop expired entries, then the least recently used beyond max_entries """
+        self.conn.execute("DELETE FROM metadata WHERE created < ?", (time.time() - self.ttl,))
+        self.conn.execute(
+            """
+            DELETE FROM metadata WHERE rowid IN (
+                SELECT rowid FROM metadata ORDER BY used DESC LIMIT -1 OFFSET ?)
+            """, (self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.conn.commit()
+            self.conn.close()
+        print("Metadata cache: {} hits, {} misses".format(self.hits, self.misses))
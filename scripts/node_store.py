@@ -0,0 +1,112 @@
+import os
+import numpy as np
+import utils
+
+"""
+Columnar storage for filtered OSM nodes. Replaces the nodes_<city>.json dicts
+of {"<node id>": [lat, lon]} with three .npy arrays (sorted int64 ids,
+float64 lats and lons) that load instantly with mmap and are searched with a
+binary search.
+"""
+
+
+class NodeStore(object):
+    """
+    Sorted node id array with matching lat/lon arrays.
+
+    Supports the dict-style lookups used on nodes_<city>.json, so it can be
+    passed anywhere those dicts were:
+
+    nodes = NodeStore.load("../data/processed/nodes_portland")
+    lat, lon = nodes.get("5542164")
+    """
+
+    def __init__(self, ids, lats, lons):
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """ Build a store from a {node_id: (lat, lon)} dict, as written by filter_osm """
+        n = len(nodes)
+        ids = np.fromiter((int(k) for k in nodes.keys()), dtype=np.int64, count=n)
+        coords = np.array(list(nodes.values()), dtype=np.float64).reshape(n, 2)
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], coords[order, 0].copy(), coords[order, 1].copy())
+
+    @classmethod
+    def load(cls, dirname, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode)
+                     for name in ['ids', 'lats', 'lons']])
+
+    def save(self, dirname):
+        os.makedirs(dirname, exist_ok=True)
+        for name in ['ids', 'lats', 'lons']:
+            np.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+        print(dirname, "saved.")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _index(self, node_id):
+        i = np.searchsorted(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return i
+        return None
+
+    def __contains__(self, node_id):
+        return self._index(int(node_id)) is not None
+
+    def get(self, node_id, default=None):
+        """ Return (lat, lon) for a node id (int or str), or default if missing """
+        i = self._index(int(node_id))
+        if i is None:
+            return default
+        return float(self.lats[i]), float(self.lons[i])
+
+    def lookup(self, node_ids):
+        """
+        Vectorized lookup of many node ids.
+        Returns arrays of lats and lons (nan where missing) and a found mask.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        lats = np.full(node_ids.shape, np.nan)
+        lons = np.full(node_ids.shape, np.nan)
+        if len(self.ids) == 0:
+            return lats, lons, np.zeros(node_ids.shape, dtype=bool)
+
+        idx = np.searchsorted(self.ids, node_ids)
+        idx[idx == len(self.ids)] = 0
+        found = self.ids[idx] == node_ids
+        lats[found] = self.lats[idx[found]]
+        lons[found] = self.lons[idx[found]]
+        return lats, lons, found
+
+
+def convert(nodes_filename, dirname):
+    """ Convert a nodes_<city>.json file into a node store directory """
+    store = NodeStore.from_nodes(utils.read_osm(nodes_filename))
+    store.save(dirname)
+    return store
+
+
+def load_region(region):
+    """
+    Load the node store for a processed region, converting
+    nodes_<region>.json the first time it is needed and again whenever the
+    json is newer than the store.
+    """
+    dirname = "../data/processed/nodes_{}".format(region)
+    ids_filename = os.path.join(dirname, 'ids.npy')
+    if (not os.path.exists(ids_filename) or
+            os.path.getmtime(ids_filename) < os.path.getmtime(dirname + '.json')):
+        convert(dirname + '.json', dirname)
+    return NodeStore.load(dirname)
+
+
+if __name__ == '__main__':
+
+    for region in ["portland", "boulder", "seattle", "pittsburgh"]:
+        load_region(region)
@@ -0,0 +1,194 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+import sys
+import capture_plan
+import download_osm
+import download_streetview
+import node_store
+import utils
+from manifest import Manifest
+
+"""
+Run the whole data pipeline for many regions at once:
+
+    download -> filter -> plan -> fetch   (per region)
+    label                                 (once, after every region)
+
+Each stage runs in its own worker process, as soon as the stages it depends
+on have finished, so independent regions proceed in parallel. Like make, a
+stage is skipped when all of its outputs exist and are newer than all of
+its inputs.
+
+    python pipeline.py "Portland, Oregon" "Boulder, Colorado"
+"""
+
+
+def city_name(region):
+    """ "Portland, Oregon" -> "portland", as used in data filenames """
+    return region.split(",")[0].lower().replace(" ", "")
+
+
+class Stage(object):
+
+    def __init__(self, name, func, args, inputs, outputs, deps=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = list(deps)
+
+    def up_to_date(self):
+        if not all(os.path.exists(f) for f in self.outputs):
+            return False
+        inputs = [f for f in self.inputs if os.path.exists(f)]
+        if not inputs:
+            return True
+        return (min(os.path.getmtime(f) for f in self.outputs) >=
+                max(os.path.getmtime(f) for f in inputs))
+
+
+def download_stage(region, raw_filename):
+    elements = download_osm.download_osm(region)
+    utils.write_osm(elements, raw_filename)
+
+
+def filter_stage(raw_filename, ways_filename, nodes_filename, node_store_dirname):
+    n_ways, n_nodes = download_osm.filter_osm_file(raw_filename, ways_filename, nodes_filename)
+    print(n_ways, "ways and", n_nodes, "nodes in", ways_filename)
+    node_store.convert(nodes_filename, node_store_dirname)
+
+
+def plan_stage(city, both_directions, spacing):
+    capture_plan.load_region_plan(city, both_directions, spacing)
+
+
+def fetch_stage(city, done_filename, fetch_options):
+    """ Fetch a region's images, marking it done once nothing is left failing """
+    download_streetview.download_region(city, **fetch_options)
+
+    manifest = Manifest("../data/manifests/streetview_{}.sqlite".format(city))
+    errors = manifest.counts().get('error', 0)
+    manifest.close()
+    if errors:
+        print(city, "has", errors, "failed captures; fetch will run again next time.")
+    else:
+        open(done_filename, 'w').close()
+
+
+def label_stage(output_filename, cities):
+    utils.get_image_labels(output_filename=output_filename, regions=cities)
+
+
+def build_stages(regions, both_directions=False, spacing=None, fetch=True, qps=20,
+                 processes=None):
+    """
+    The stages for a list of regions, in dependency order. processes is the
+    size of the pool they will run on (default: one per CPU, as in run).
+    """
+    stages = []
+    label_deps = []
+    label_inputs = []
+    cities = [city_name(region) for region in regions]
+    # The QPS budget is shared by the regions that can be fetching at once
+    concurrent_fetches = min(len(regions), processes or os.cpu_count() or 1)
+
+    for region in regions:
+        city = city_name(region)
+        raw_filename = "../data/raw/raw_osm_{}.json".format(city)
+        ways_filename = "../data/processed/ways_{}.json".format(city)
+        nodes_filename = "../data/processed/nodes_{}.json".format(city)
+        node_store_dirname = "../data/processed/nodes_{}".format(city)
+        plan_filename = capture_plan.region_plan_filename(city, both_directions, spacing)
+        done_filename = "../data/manifests/streetview_{}.done".format(city)
+
+        download = Stage('download ' + city, download_stage, (region, raw_filename),
+                         [], [raw_filename])
+        filter_ = Stage('filter ' + city, filter_stage,
+                        (raw_filename, ways_filename, nodes_filename, node_store_dirname),
+                        [raw_filename],
+                        [ways_filename, nodes_filename,
+                         os.path.join(node_store_dirname, 'ids.npy')],
+                        [download])
+        plan = Stage('plan ' + city, plan_stage, (city, both_directions, spacing),
+                     [ways_filename, os.path.join(node_store_dirname, 'ids.npy')],
+                     [plan_filename], [filter_])
+        stages += [download, filter_, plan]
+        label_deps.append(filter_)
+        label_inputs.append(ways_filename)
+
+        if fetch:
+            fetch_options = {'qps': qps / concurrent_fetches, 'both_directions': both_directions,
+                             'spacing': spacing}
+            fetch_ = Stage('fetch ' + city, fetch_stage, (city, done_filename, fetch_options),
+                           [plan_filename], [done_filename], [plan])
+            stages.append(fetch_)
+            label_deps.append(fetch_)
+            label_inputs.append(done_filename)
+
+    stages.append(Stage('label', label_stage, ("../descriptives/image_labels.csv", cities),
+                        label_inputs, ["../descriptives/image_labels.csv"], label_deps))
+    return stages
+
+
+def run(stages, processes=None, force=False):
+    """
+    Run stages on a process pool, each once its dependencies are done.
+    A failed stage is reported and everything depending on it is skipped.
+    """
+    for d in ['../data/raw', '../data/processed', '../data/plans', '../data/manifests',
+              '../data/images', '../descriptives']:
+        os.makedirs(d, exist_ok=True)
+
+    done = set()
+    failed = set()
+    waiting = list(stages)
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while waiting or running:
+
+            progress = False
+            for stage in list(waiting):
+                if any(d in failed for d in stage.deps):
+                    print("Skipping", stage.name, "(a dependency failed)")
+                    failed.add(stage)
+                    waiting.remove(stage)
+                    progress = True
+                elif all(d in done for d in stage.deps):
+                    waiting.remove(stage)
+                    progress = True
+                    if not force and stage.up_to_date():
+                        print("Up to date:", stage.name)
+                        done.add(stage)
+                    else:
+                        print("Starting:", stage.name)
+                        running[pool.submit(stage.func, *stage.args)] = stage
+
+            if not running:
+                if not progress:
+                    raise ValueError("Stages depend on stages that were never given")
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    print("Failed:", stage.name, repr(e))
+                    failed.add(stage)
+                else:
+                    print("Finished:", stage.name)
+                    done.add(stage)
+
+    return done, failed
+
+
+if __name__ == '__main__':
+
+    regions = sys.argv[1:] or ["Portland, Oregon",
+                               "Boulder, Colorado",
+                               "Seattle, Washington",
+                               "Pittsburgh, Pennsylvania"]
+    run(build_stages(regions))
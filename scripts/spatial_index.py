@@ -0,0 +1,188 @@
+import sys
+import numpy as np
+import node_store
+import utils
+from manifest import Manifest
+
+"""
+Spatial index over the segments of a region's ways, for questions like
+"which way is this panorama actually on?". Street View sometimes snaps a
+request to a nearby but different road 30-40 metres away; match_panoramas()
+uses the index to record which way each downloaded panorama is nearest to.
+
+    python spatial_index.py portland
+
+Coordinates are projected to metres on a plane tangent at the centre of the
+region (accurate to well under 1% across a city) and segments are bucketed
+into a uniform grid of square cells.
+"""
+
+METRES_PER_DEGREE = 111320.0
+
+
+class WayIndex(object):
+    """
+    Uniform grid index over way segments.
+
+    index = WayIndex.from_region(ways, nodes)
+    way_id, distance = index.nearest(45.52, -122.68)
+    """
+
+    def __init__(self, way_ids, lat1, lon1, lat2, lon2, cell_size=50.0):
+        self.cell_size = cell_size
+        self.lat0 = (np.mean(lat1) + np.mean(lat2)) / 2 if len(lat1) else 0.0
+        self.lon0 = (np.mean(lon1) + np.mean(lon2)) / 2 if len(lon1) else 0.0
+        self.metres_per_lon = METRES_PER_DEGREE * np.cos(np.radians(self.lat0))
+
+        self.way_ids = way_ids
+        self.x1, self.y1 = self.project(lat1, lon1)
+        self.x2, self.y2 = self.project(lat2, lon2)
+
+        # Every cell overlapped by each segment's bounding box
+        cx0 = np.floor(np.minimum(self.x1, self.x2) / cell_size).astype(np.int64)
+        cx1 = np.floor(np.maximum(self.x1, self.x2) / cell_size).astype(np.int64)
+        cy0 = np.floor(np.minimum(self.y1, self.y2) / cell_size).astype(np.int64)
+        cy1 = np.floor(np.maximum(self.y1, self.y2) / cell_size).astype(np.int64)
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+
+        seg = np.repeat(np.arange(len(way_ids)), nx * ny)
+        k = np.arange(len(seg)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+        cx = cx0[seg] + k % nx[seg]
+        cy = cy0[seg] + k // nx[seg]
+
+        keys = self._keys(cx, cy)
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.cell_start = np.unique(keys[order], return_index=True)
+        self.cell_end = np.append(self.cell_start[1:], len(order))
+        self.cell_segments = seg[order]
+
+    @classmethod
+    def from_region(cls, ways, nodes, cell_size=50.0):
+        """ Index the segments of a dict of ways, with coordinates from a NodeStore """
+        if not isinstance(nodes, node_store.NodeStore):
+            nodes = node_store.NodeStore.from_nodes(nodes)
+
+        ways = list(ways.values())
+        lengths = np.array([len(w.get('nodes', [])) for w in ways], dtype=np.int64)
+        flat_ids = np.fromiter((n for w in ways for n in w.get('nodes', [])),
+                               dtype=np.int64, count=int(lengths.sum()))
+        flat_way = np.repeat(np.array([w['id'] for w in ways], dtype=np.int64), lengths)
+        lats, lons, found = nodes.lookup(flat_ids)
+
+        flat_way, lats, lons = flat_way[found], lats[found], lons[found]
+        a = np.flatnonzero(flat_way[:-1] == flat_way[1:])
+        return cls(flat_way[a], lats[a], lons[a], lats[a + 1], lons[a + 1], cell_size)
+
+    def project(self, lat, lon):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        return (lon - self.lon0) * self.metres_per_lon, (lat - self.lat0) * METRES_PER_DEGREE
+
+    @staticmethod
+    def _keys(cx, cy):
+        return (cx << 32) + (cy & 0xffffffff)
+
+    def _segments_in_cells(self, cx0, cx1, cy0, cy1):
+        if len(self.cell_keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        cx, cy = np.meshgrid(np.arange(cx0, cx1 + 1), np.arange(cy0, cy1 + 1))
+        keys = self._keys(cx.ravel(), cy.ravel())
+        i = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        i = i[self.cell_keys[i] == keys]
+        if len(i) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.cell_segments[s:e]
+                                         for s, e in zip(self.cell_start[i], self.cell_end[i])]))
+
+    def nearest(self, lat, lon, max_distance=50.0):
+        """
+        The way nearest to a point, and its distance in metres, looking no
+        further than max_distance. Returns (None, None) if nothing is in range.
+        """
+        x, y = self.project(lat, lon)
+        r = max_distance / self.cell_size
+        segs = self._segments_in_cells(int(np.floor(x / self.cell_size - r)),
+                                       int(np.floor(x / self.cell_size + r)),
+                                       int(np.floor(y / self.cell_size - r)),
+                                       int(np.floor(y / self.cell_size + r)))
+        if len(segs) == 0:
+            return None, None
+
+        d = self._distances(x, y, segs)
+        best = np.argmin(d)
+        if d[best] > max_distance:
+            return None, None
+        return int(self.way_ids[segs[best]]), float(d[best])
+
+    def nearest_many(self, lats, lons, max_distance=50.0):
+        """ nearest() for arrays of points: way ids (-1 if none) and distances (nan) """
+        way_ids = np.full(len(lats), -1, dtype=np.int64)
+        distances = np.full(len(lats), np.nan)
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            way_id, distance = self.nearest(lat, lon, max_distance)
+            if way_id is not None:
+                way_ids[i], distances[i] = way_id, distance
+        return way_ids, distances
+
+    def _distances(self, x, y, segs):
+        """ Distances in metres from (x, y) to each of the given segments """
+        x1, y1, x2, y2 = self.x1[segs], self.y1[segs], self.x2[segs], self.y2[segs]
+        dx, dy = x2 - x1, y2 - y1
+        length2 = dx * dx + dy * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(length2 > 0, ((x - x1) * dx + (y - y1) * dy) / length2, 0.0)
+        t = np.clip(t, 0, 1)
+        return np.hypot(x1 + t * dx - x, y1 + t * dy - y)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """ Ids of the ways with a segment whose bounding box meets the given box """
+        x0, y0 = self.project(min_lat, min_lon)
+        x1, y1 = self.project(max_lat, max_lon)
+        segs = self._segments_in_cells(int(np.floor(x0 / self.cell_size)),
+                                       int(np.floor(x1 / self.cell_size)),
+                                       int(np.floor(y0 / self.cell_size)),
+                                       int(np.floor(y1 / self.cell_size)))
+        if len(segs) == 0:
+            return set()
+
+        hit = ((np.maximum(self.x1[segs], self.x2[segs]) >= x0) &
+               (np.minimum(self.x1[segs], self.x2[segs]) <= x1) &
+               (np.maximum(self.y1[segs], self.y2[segs]) >= y0) &
+               (np.minimum(self.y1[segs], self.y2[segs]) <= y1))
+        return set(self.way_ids[segs[hit]].tolist())
+
+
+def load_region_index(region, cell_size=50.0):
+    ways = utils.read_osm("../data/processed/ways_{}.json".format(region))
+    return WayIndex.from_region(ways, node_store.load_region(region), cell_size)
+
+
+def match_panoramas(region, max_distance=50.0):
+    """
+    For every panorama in a region's manifest, record the way it is nearest
+    to (matched_way_id) and report how many were snapped to a different way
+    than the one requested.
+    """
+    index = load_region_index(region)
+    manifest = Manifest("../data/manifests/streetview_{}.sqlite".format(region))
+
+    rows = manifest.conn.execute(
+        "SELECT filename, way_id, pano_lat, pano_lon FROM captures WHERE pano_lat IS NOT NULL"
+    ).fetchall()
+    if not rows:
+        print("No panorama locations in manifest.")
+        return
+
+    filenames, requested, lats, lons = zip(*rows)
+    matched, _ = index.nearest_many(lats, lons, max_distance)
+    manifest.set_matched_ways(zip(filenames, [None if m < 0 else m for m in matched.tolist()]))
+
+    moved = int(np.sum((matched >= 0) & (matched != np.array(requested))))
+    print("{} of {} panoramas are nearest to a different way".format(moved, len(rows)))
+    manifest.close()
+
+
+if __name__ == '__main__':
+
+    match_panoramas(sys.argv[1])
@@ -0,0 +1,120 @@
+import csv
+import hashlib
+import os
+import sys
+import numpy as np
+import label_index
+import node_store
+
+"""
+Deterministic train/val/test splits. Every image is assigned to a split by
+a stable hash of a group key, so assignments never change when images are
+added, and the split is written as small CSV manifests instead of copying
+images into train/val/test folders.
+
+Group keys:
+    way     all images of a way share a split (default)
+    block   all images in the same square block of a city share a split,
+            so adjacent streets can't leak between train and test
+
+    python splits.py [way|block]
+"""
+
+SPLITS = ['train', 'val', 'test']
+
+# Percent of groups in each split, as in the original i % 5 assignment
+SPLIT_PERCENTS = {'test': 20, 'val': 20, 'train': 60}
+
+
+def split_of(key, seed=''):
+    """ train, val or test for a group key, from a stable hash """
+    bucket = int(hashlib.md5((seed + str(key)).encode('utf-8')).hexdigest(), 16) % 100
+    if bucket < SPLIT_PERCENTS['test']:
+        return 'test'
+    if bucket < SPLIT_PERCENTS['test'] + SPLIT_PERCENTS['val']:
+        return 'val'
+    return 'train'
+
+
+def image_node_id(filename):
+    """ Node id of an image named w<way>_n<node>...jpg, or -1 """
+    try:
+        return int(os.path.splitext(filename)[0].split('_')[1][1:])
+    except (IndexError, ValueError):
+        return -1
+
+
+def block_keys(rows, block_size=500.0):
+    """
+    Block keys (region plus the block_size metre grid cell of the image's
+    node) for label rows. Images whose node can't be found fall back to
+    their way id.
+    """
+    keys = ['way{}'.format(label_index.image_way_id(r['filename'])) for r in rows]
+
+    by_region = {}
+    for i, row in enumerate(rows):
+        by_region.setdefault(row['region'], []).append(i)
+
+    for region, indices in by_region.items():
+        if not region:
+            continue
+        nodes = node_store.load_region(region)
+        lats, lons, found = nodes.lookup([image_node_id(rows[i]['filename']) for i in indices])
+        lats, lons = np.where(found, lats, 0), np.where(found, lons, 0)
+        cell_lat = np.floor(lats * 111320.0 / block_size).astype(np.int64)
+        cell_lon = np.floor(lons * 111320.0 * np.cos(np.radians(lats)) / block_size).astype(np.int64)
+        for j, i in enumerate(indices):
+            if found[j]:
+                keys[i] = '{}:{}:{}'.format(region, cell_lat[j], cell_lon[j])
+    return keys
+
+
+def assign_splits(rows, group='way', seed='', block_size=500.0):
+    """ The split of each label row (dicts with filename, region and label) """
+    if group == 'way':
+        keys = [label_index.image_way_id(r['filename']) for r in rows]
+    elif group == 'block':
+        keys = block_keys(rows, block_size)
+    else:
+        raise ValueError("Unknown split group: {}".format(group))
+    return [split_of(k, seed) for k in keys]
+
+
+def write_split_manifests(labels_filename='../descriptives/image_labels.csv',
+                          out_dir='../data/splits/', image_dir='../data/images/',
+                          group='way', seed='', block_size=500.0, store=None):
+    """
+    Write <out_dir>/<split>.csv manifests (filename, path, label, region)
+    for the images in labels_filename. Paths point into image_dir, or into
+    an image_store.ImageStore if one is given.
+    """
+    with open(labels_filename, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    splits = assign_splits(rows, group, seed, block_size)
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = {s: open(os.path.join(out_dir, s + '.csv'), 'w', newline='') for s in SPLITS}
+    writers = {s: csv.writer(f) for s, f in files.items()}
+    for writer in writers.values():
+        writer.writerow(['filename', 'path', 'label', 'region'])
+
+    counts = {s: 0 for s in SPLITS}
+    for row, split in zip(rows, splits):
+        if store is not None:
+            path = store.path(row['filename'])
+        else:
+            path = os.path.join(image_dir, row['filename'])
+        writers[split].writerow([row['filename'], path, row['label'], row['region']])
+        counts[split] += 1
+
+    for f in files.values():
+        f.close()
+    print("Split manifests saved to", out_dir, counts)
+    return counts
+
+
+if __name__ == '__main__':
+
+    write_split_manifests(group=sys.argv[1] if len(sys.argv) > 1 else 'way')
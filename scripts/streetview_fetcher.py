@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from geographiclib.geodesic import Geodesic
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+Concurrent Street View downloader. Captures (one image location and heading
+each) are fetched by a pool of worker threads sharing one pooled HTTP
+session, under a global requests-per-second limit, with retries and
+exponential backoff on throttling, server errors and dropped connections.
+
+Run this script to fetch a few captures from a local stand-in server.
+"""
+
+BASE_URL = 'https://maps.googleapis.com/maps/api'
+
+# Responses worth retrying: throttled, or a transient server error
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def query_params(capture, key=None):
+    """ Street View query parameters for a capture """
+    return {
+        'size': '640x640',
+        'location': "{},{}".format(capture['lat'], capture['lon']),
+        'heading': capture['heading'],
+        'pitch': '0',
+        'key': key if key is not None else os.environ['GOOGLE_MAPS_API_KEY'],
+        'radius': 10
+    }
+
+
+class RateLimiter(object):
+    """ Thread-safe limiter spacing calls evenly at no more than qps per second """
+
+    def __init__(self, qps):
+        self.interval = 1.0 / qps if qps else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def make_session(pool_size):
+    """ A requests session keeping up to pool_size connections alive per host """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_with_retries(session, url, params, limiter, retries=4, backoff=0.5, timeout=30):
+    """
+    GET url, retrying with exponential backoff (plus jitter) on connection
+    errors and retryable status codes. Returns the last response, or raises
+    the last connection error once retries are used up.
+    """
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            r = session.get(url, params=params, timeout=timeout)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return r
+
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def get_metadata(session, params, limiter, base_url=BASE_URL, cache=None):
+    """
+    Metadata response for a query, from the cache if possible.
+    Returns the response dict, and the HTTP status (None if cached).
+    """
+    lat, lon = params['location'].split(',')
+    if cache is not None:
+        metadata = cache.get(lat, lon, params['radius'])
+        if metadata is not None:
+            return metadata, None
+
+    r = get_with_retries(session, base_url + '/streetview/metadata', params, limiter)
+    if r.status_code != 200:
+        return None, r.status_code
+
+    metadata = r.json()
+    if cache is not None:
+        cache.put(lat, lon, params['radius'], metadata)
+    return metadata, r.status_code
+
+
+def fetch_capture(session, capture, limiter, image_dir, download=True,
+                  base_url=BASE_URL, key=None, cache=None, store=None):
+    """
+    Fetch the metadata for a capture and, if an image is available, the
+    image itself. Returns a result dict describing what happened.
+
+    Images are saved to image_dir, or to an image_store.ImageStore if one
+    is given.
+    """
+    result = {'filename': capture['filename'], 'way_id': capture['way_id'],
+              'node_id': capture['node_id'], 'heading': capture['heading'], 'distance': None,
+              'http_status': None, 'filepath': None}
+    params = query_params(capture, key)
+
+    try:
+        # Fist, do a meta-data query to see if the image is available.
+        metadata, result['http_status'] = get_metadata(session, params, limiter,
+                                                       base_url, cache)
+        if metadata is None:
+            result['status'] = 'error'
+            return result
+
+        if metadata['status'] != 'OK':
+            result['status'] = 'no_image'
+            return result
+
+        # Check the distance between our OSM node and Street View image
+        result['pano_lat'] = metadata['location']['lat']
+        result['pano_lon'] = metadata['location']['lng']
+        result['distance'] = Geodesic.WGS84.Inverse(
+            result['pano_lat'], result['pano_lon'], capture['lat'], capture['lon'])['s12']
+
+        if not download:
+            result['status'] = 'available'
+            return result
+
+        r = get_with_retries(session, base_url + '/streetview', params, limiter)
+        result['http_status'] = r.status_code
+        if r.status_code != 200:
+            result['status'] = 'error'
+            return result
+
+        if store is not None:
+            filepath, result['duplicate'] = store.put(capture['filename'], r.content)
+        else:
+            filepath = os.path.join(image_dir, capture['filename'])
+            with open(filepath, 'wb') as f:
+                f.write(r.content)
+        result['filepath'] = filepath
+        result['status'] = 'ok'
+
+    except (requests.RequestException, ValueError, KeyError) as e:
+        result['status'] = 'error'
+        result['error'] = repr(e)
+
+    return result
+
+
+def fetch_captures(captures, image_dir='../data/images/', workers=8, qps=20,
+                   download=True, base_url=BASE_URL, key=None, cache=None, store=None):
+    """
+    Fetch many captures concurrently, yielding result dicts as they finish
+    (not in input order). Only about 2 * workers captures are in flight at a
+    time, so captures can be a lazy generator over a whole region.
+
+    If a metadata_cache.MetadataCache is given, it is checked before every
+    metadata request. If an image_store.ImageStore is given, images are
+    saved there instead of to image_dir.
+    """
+    if download and store is None:
+        os.makedirs(image_dir, exist_ok=True)
+    limiter = RateLimiter(qps)
+    session = make_session(workers)
+    captures = iter(captures)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def submit_next():
+            capture = next(captures, None)
+            if capture is None:
+                return None
+            return pool.submit(fetch_capture, session, capture, limiter,
+                               image_dir, download, base_url, key, cache, store)
+
+        pending = set()
+        for _ in range(2 * workers):
+            future = submit_next()
+            if future is None:
+                break
+            pending.add(future)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                future = submit_next()
+                if future is not None:
+                    pending.add(future)
+
+    session.close()
+
+
+def test_local_fetcher(n_captures=200):
+    """ Fetch synthetic captures from the local stand-in server """
+    import tempfile
+    import fake_streetview_server
+    from metadata_cache import MetadataCache
+    from image_store import ImageStore
+
+    server = fake_streetview_server.start(fail_rate=0.1)
+    base_url = 'http://{}:{}/maps/api'.format(*server.server_address)
+
+    captures = [{'way_id': i, 'node_id': i, 'lat': 45.5 + i * 1e-4,
+                 'lon': -122.6, 'heading': 90.0, 'filename': 'w{}_n{}.jpg'.format(i, i)}
+                for i in range(n_captures)]
+
+    image_dir = tempfile.mkdtemp()
+    cache = MetadataCache(os.path.join(image_dir, 'cache', 'metadata.sqlite'))
+
+    # Second pass is a dry run answered entirely from the metadata cache
+    for download in [True, False]:
+        start = time.monotonic()
+        statuses = {}
+        for result in fetch_captures(captures, image_dir, workers=16, qps=500,
+                                     download=download, base_url=base_url,
+                                     key='test', cache=cache):
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        elapsed = time.monotonic() - start
+        print(statuses, "in {:.2f} seconds".format(elapsed))
+        assert sum(statuses.values()) == n_captures
+
+    assert cache.hits == n_captures
+    cache.close()
+    assert statuses.get('available', 0) == len(os.listdir(image_dir)) - 1
+
+    # The stand-in serves the same bytes for every image, so the store keeps one
+    store = ImageStore(os.path.join(image_dir, 'store'))
+    for result in fetch_captures(captures[:20], image_dir, workers=4, qps=500,
+                                 base_url=base_url, key='test', store=store):
+        assert result['status'] != 'ok' or store.path(result['filename']) == result['filepath']
+    assert len(store.duplicates()) == 1
+    store.close()
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+
+    test_local_fetcher()
@@ -0,0 +1,143 @@
+import sys
+import numpy as np
+import utils
+
+"""
+Tag statistics over large sets of ways. The tags of every way are flattened
+once into a columnar (way, key, value) table with integer-coded keys and
+values, and all frequency reports are grouped counts over that table.
+
+Running this script writes side-by-side descriptives for selected cities.
+"""
+
+
+class TagTable(object):
+    """
+    One row per (way, tag) pair: way, key and value are int32 codes into
+    way_ids, keys and values.
+
+    table = TagTable.from_ways(ways)
+    table.key_freq()                # like utils.tag_freq(ways)
+    table.value_freq('bicycle')     # like utils.tag_value_freq(ways, 'bicycle')
+    """
+
+    def __init__(self, way_ids, way, key, value, keys, values):
+        self.way_ids = way_ids
+        self.way = way
+        self.key = key
+        self.value = value
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_ways(cls, ways):
+        """ Flatten a dict of ways (as in ways_<city>.json) """
+        key_codes = {}
+        value_codes = {}
+        way_ids = []
+        way, key, value = [], [], []
+
+        for i, ele in enumerate(ways.values()):
+            way_ids.append(ele.get('id'))
+            for k, v in ele.get('tags', {}).items():
+                way.append(i)
+                key.append(key_codes.setdefault(k, len(key_codes)))
+                value.append(value_codes.setdefault(v, len(value_codes)))
+
+        return cls(np.array(way_ids, dtype=np.int64),
+                   np.array(way, dtype=np.int32),
+                   np.array(key, dtype=np.int32),
+                   np.array(value, dtype=np.int32),
+                   list(key_codes), list(value_codes))
+
+    @property
+    def n_ways(self):
+        return len(self.way_ids)
+
+    def tag_values(self, key):
+        """ Value of a tag for every way, as value codes (-1 where the tag is missing) """
+        codes = np.full(self.n_ways, -1, dtype=np.int32)
+        if key in self.keys:
+            rows = self.key == self.keys.index(key)
+            codes[self.way[rows]] = self.value[rows]
+        return codes
+
+    def select_ways(self, mask):
+        """ A table of just the ways where mask (one bool per way) is True """
+        new_index = np.cumsum(mask) - 1
+        rows = mask[self.way]
+        return TagTable(self.way_ids[mask], new_index[self.way[rows]].astype(np.int32),
+                        self.key[rows], self.value[rows], self.keys, self.values)
+
+    def exclude(self, key, excluded_values):
+        """ Drop the ways whose value of key is one of excluded_values """
+        excluded = [self.values.index(v) for v in excluded_values if v in self.values]
+        return self.select_ways(~np.isin(self.tag_values(key), excluded))
+
+    def key_freq(self):
+        """ Number of ways with each tag key, in order of first appearance """
+        codes, first, counts = np.unique(self.key, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return {self.keys[k]: n for k, n in zip(codes[order].tolist(), counts[order].tolist())}
+
+    def value_freqs(self, keys):
+        """
+        Frequencies of the values of several tags. Ways without a tag are
+        counted under None, and each tag's values are in order of first
+        appearance, as in utils.tag_value_freq, so ties sort the same way.
+        """
+        freqs = {}
+        for k in keys:
+            codes, first, counts = np.unique(self.tag_values(k), return_index=True,
+                                             return_counts=True)
+            order = np.argsort(first)
+            freqs[k] = {self.values[v] if v >= 0 else None: n
+                        for v, n in zip(codes[order].tolist(), counts[order].tolist())}
+        return freqs
+
+    def value_freq(self, key):
+        return self.value_freqs([key])[key]
+
+
+def write_comparative_descriptives(regions, tags, outfile, num_to_show=20):
+    """
+    For each tag, write the most common values across regions, with each
+    region's count and share of its ways side by side.
+    """
+    region_freqs = {}
+    region_ways = {}
+    for region in regions:
+        table = TagTable.from_ways(utils.read_osm("../data/processed/ways_{}.json".format(region)))
+        region_freqs[region] = table.value_freqs(tags)
+        region_ways[region] = table.n_ways
+
+    with open(outfile, 'w') as f:
+        f.write('ways: ' + '  '.join('{} {}'.format(r, region_ways[r]) for r in regions) + '\n')
+
+        for tag in tags:
+            f.write('\n************\n {} \n************\n'.format(tag))
+            totals = {}
+            for region in regions:
+                for value, n in region_freqs[region][tag].items():
+                    totals[value] = totals.get(value, 0) + n
+
+            f.write('{:<24}'.format('value') +
+                    ''.join('{:>22}'.format(r) for r in regions) + '\n')
+            for value, _ in utils.sort_by_value(totals)[::-1][:num_to_show]:
+                f.write('{:<24}'.format(str(value)[:23]))
+                for region in regions:
+                    n = region_freqs[region][tag].get(value, 0)
+                    share = n / region_ways[region] if region_ways[region] else 0
+                    f.write('{:>14} ({:>5.1%})'.format(n, share))
+                f.write('\n')
+
+    print(outfile, "saved.")
+
+
+if __name__ == '__main__':
+
+    regions = sys.argv[1:] or ["portland", "boulder", "seattle", "pittsburgh"]
+    write_comparative_descriptives(
+        regions,
+        ['highway', 'sidewalk', 'bicycle', 'lanes', 'oneway', 'cycleway', 'maxspeed'],
+        "../descriptives/region_comparison.txt")
@@ -5,6 +5,7 @@ selected cities.
 Josh Sennett
 """
 import json
+import re
 
 
 def write_osm(elements, filename):
@@ -19,6 +20,93 @@ def read_osm(filename):
     return elements
 
 
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_osm(filename, chunk_size=1 << 20):
+    """
+    Iterate over the elements of a raw OSM file one at a time, without
+    loading the whole file into memory.
+
+    Reads the JSON element lists written by write_osm, or .osm.pbf extracts
+    if pyosmium is installed.
+
+    For example:
+    for ele in iter_osm("../data/raw/raw_osm_portland.json"): ...
+    """
+    if filename.endswith('.pbf'):
+        yield from iter_pbf(filename)
+        return
+
+    decoder = json.JSONDecoder()
+    with open(filename) as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError("{} is not a list of OSM elements".format(filename))
+
+        pos = 1
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if buf.startswith(']', pos):
+                return
+
+            try:
+                ele, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Element runs past the end of the buffer; read more of it
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+
+            yield ele
+
+
+def iter_pbf(filename):
+    """ Iterate over the nodes and ways of an .osm.pbf extract, in Overpass JSON format """
+    import osmium
+
+    for obj in osmium.FileProcessor(filename, osmium.osm.NODE | osmium.osm.WAY):
+        ele = {'id': obj.id}
+        if obj.is_node():
+            if not obj.location.valid():
+                continue
+            ele['type'] = 'node'
+            ele['lat'] = obj.location.lat
+            ele['lon'] = obj.location.lon
+        else:
+            ele['type'] = 'way'
+            ele['nodes'] = [n.ref for n in obj.nodes]
+
+        tags = {t.k: t.v for t in obj.tags}
+        if tags:
+            ele['tags'] = tags
+        yield ele
+
+
+def write_osm_items(items, filename):
+    """
+    Write (key, value) pairs to filename as one JSON object, one item at a
+    time. The file reads back with read_osm like a dict saved by write_osm.
+    Returns the number of items written.
+    """
+    n = 0
+    with open(filename, 'w') as f:
+        f.write('{')
+        for key, value in items:
+            if n > 0:
+                f.write(', ')
+            f.write(json.dumps(str(key)))
+            f.write(': ')
+            f.write(json.dumps(value))
+            n += 1
+        f.write('}')
+    print(filename, "saved.")
+    return n
+
+
 def tag_value_freq(elements, tag):
     """
     Get the frequency of the tag values in a list of elements (nodes or ways)
@@ -64,30 +152,30 @@ def display_results(osm_data):
 
 
 def write_ways_descriptives(ways_filename, outfile, excluded_highways=None, num_to_show=50):
+    from tag_stats import TagTable
 
-    # Read in file
-    ways = read_osm(ways_filename)
+    # Read in file, and flatten its tags once
+    table = TagTable.from_ways(read_osm(ways_filename))
 
     # exclude certain ways, if this option is specified
     if excluded_highways is not None:
-        filtered_ways = {}
-        for way in ways:
-            if ways.get(way).get('tags').get('highway') not in excluded_highways:
-                filtered_ways[way] = ways[way]
-        ways = filtered_ways
+        table = table.exclude('highway', excluded_highways)
+
+    tags_of_interest = ['highway', 'sidewalk', 'bicycle', 'lanes', 'oneway', 'cycleway',
+                        'RLIS:bicycle', 'source:bicycle']
+    value_freqs = table.value_freqs(tags_of_interest)
 
     # Tag frequencies
-    tags = sort_by_value(tag_freq(ways)) # returns a list of (tag, freq) pairs
+    tags = sort_by_value(table.key_freq()) # returns a list of (tag, freq) pairs
     with open(outfile, 'w') as f:
 
         for (t, n) in tags[-num_to_show:]:
             f.write("{} - {}\n".format(t, n))
 
-        for tag in ['highway', 'sidewalk', 'bicycle', 'lanes', 'oneway', 'cycleway',
-                    'RLIS:bicycle', 'source:bicycle']:
+        for tag in tags_of_interest:
 
             f.write('\n************\n {} \n************\n'.format(tag))
-            tag_value_freqs = tag_value_freq(ways, tag)
+            tag_value_freqs = value_freqs[tag]
             sorted_value_freqs = sort_by_value(tag_value_freqs)
 
             for (t, n) in sorted_value_freqs[-num_to_show:]:
@@ -100,119 +188,85 @@ def write_ways_descriptives(ways_filename, outfile, excluded_highways=None, num_
     print(outfile, "saved.")
 
 
-def get_image_labels(output_filename=None):
-
+def get_image_labels(output_filename=None, image_dir='../data/images/', regions=None):
+    """
+    Label every image in image_dir from the tags of its way, looked up in
+    the prebuilt label index (see label_index.py) of regions (by default
+    label_index.REGIONS). Rows are written to output_filename as they are
+    produced, if given.
+
+    Every region is searched. The original loop stopped after Boulder (its
+    .get('tags', {}) never returned None), so images of the other regions
+    were all labelled 0; many of them are now labelled 1. If output_filename
+    already exists, the number of labels that changed from it is printed.
+    """
     import os
     import csv
-    filenames = os.listdir('../data/images/')
+    import label_index
 
-    all_way_info = {
-        'portland': read_osm("../data/processed/ways_portland.json"),
-        'pittsburgh': read_osm("../data/processed/ways_pittsburgh.json"),
-        'seattle': read_osm("../data/processed/ways_seattle.json"),
-        'boulder': read_osm("../data/processed/ways_boulder.json"),
-    }
+    previous = {}
+    if output_filename is not None and os.path.exists(output_filename):
+        with open(output_filename, newline='') as f:
+            previous = {row['filename']: int(row['label']) for row in csv.DictReader(f)}
 
-    # return road_characteristics
-    rows = []
-    not_found = 0
-    for filename in filenames:
+    regions = regions or label_index.REGIONS
+    index = label_index.load_label_index(regions)
+    filenames = (entry.name for entry in os.scandir(image_dir)
+                 if entry.is_file() and entry.name.endswith('.jpg'))
 
-        row = {}
-        way_id = filename.split('_')[0][1:]
-        way_info = None
+    keys = ['filename', 'region'] + label_index.LABEL_TAGS + ['label']
+    outfile = open(output_filename, 'w', newline='') if output_filename is not None else None
+    if outfile is not None:
+        dict_writer = csv.DictWriter(outfile, keys)
+        dict_writer.writeheader()
 
-        for region in ["boulder", "pittsburgh", "seattle", "portland"]:
-
-            if way_info is None:
-                way_info = all_way_info.get(region, {}).get(way_id, {}).get('tags', {})
-                row['region'] = all_way_info.get(region)
+    rows = []
+    not_found = 0
+    for row in label_index.iter_image_labels(filenames, index, regions):
 
-        # Add way characteristics
-        if way_info == {}:
-            print(filename, "not found *******")
+        if row['region'] == '':
+            print(row['filename'], "not found *******")
             not_found += 1
 
-        row['filename'] = filename
-
-        for tag in ['highway', 'bicycle', 'cycleway', 'lanes', 'maxspeed', 'oneway']:
-            row[tag] = way_info.get(tag, '').strip()
-
-        # Determine the image label from its characteristics
-        if (row['bicycle'] == 'designated' or 'yes' in row['bicycle'] or
-            row['cycleway'] in ['lane', 'shared', 'shared_lane',
-                                'opposite_lane', 'yes', 'cycle_greenway',
-                                'track', 'share_busway']):
-            row['label'] = 1
-        else:
-            row['label'] = 0
-
+        if outfile is not None:
+            dict_writer.writerow(row)
         rows.append(row)
 
     # Optional - write to file.
-    if output_filename is not None:
-        keys = rows[0].keys()
-        with open(output_filename, 'w') as outfile:
-            dict_writer = csv.DictWriter(outfile, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(rows)
-            print(output_filename, "saved with", len(rows), "rows." )
+    if outfile is not None:
+        outfile.close()
+        print(output_filename, "saved with", len(rows), "rows." )
 
     print(not_found, 'not found')
+    if previous:
+        changed = {}
+        for row in rows:
+            if row['filename'] in previous and previous[row['filename']] != row['label']:
+                changed[row['region']] = changed.get(row['region'], 0) + 1
+        print(sum(changed.values()), 'labels changed from the previous', output_filename,
+              changed)
     return rows
 
 
-def organize_images():
-
-    from shutil import copyfile
-    import pandas as pd
-
-    df = pd.read_csv('../descriptives/image_labels.csv')
-    labels = dict(zip(df['filename'],df['label']))
-
-    i = 0
-    for filename in labels.keys():
-
-        if i % 5 == 0:
-            group = 'test'
-        elif i % 5 == 1:
-            group = 'val'
-        else:
-            group = 'train'
-
-        from_path = '../data/images/%s' % filename
-        to_path = '../data/images/%s/%d/%s' % (group, labels[filename], filename)
-        copyfile(from_path, to_path)
-
+def organize_images(group='way'):
+    """
+    Split the labeled images into train/val/test by a stable hash of their
+    way (see splits.py), writing split manifests to ../data/splits/ instead
+    of copying the images.
+    """
+    import splits
+    splits.write_split_manifests('../descriptives/image_labels.csv', '../data/splits/',
+                                 group=group)
 
-        i += 1
-        if i % 1000 == 0: print(i, 'of', len(df))
 
 def organize_images_by_city():
-
-    from shutil import copyfile
-    import pandas as pd
-
-    df = pd.read_csv('../descriptives/image_labels.csv')
-    labels = dict(zip(df['filename'],df['label']))
-
-    i = 0
-    for filename in labels.keys():
-
-        if i % 5 == 0:
-            group = 'test'
-        elif i % 5 == 1:
-            group = 'val'
-        else:
-            group = 'train'
-
-        from_path = '../data/images/%s' % filename
-        to_path = '../data/images/%s/%d/%s' % (group, labels[filename], filename)
-        copyfile(from_path, to_path)
-
-
-        i += 1
-        if i % 1000 == 0: print(i, 'of', len(df))
+    """
+    Split the labeled images by 500m blocks within each city, so neighbouring
+    streets land in the same split. Manifests go to ../data/splits_by_block/.
+    """
+    import splits
+    splits.write_split_manifests('../descriptives/image_labels.csv', '../data/splits_by_block/',
+                                 group='block')
 
 
 def city_to_images():